@@ -0,0 +1,190 @@
+"""Benchmarks for the compile and render pipeline in jinjasql.core"""
+import threading
+
+from jinja2 import DictLoader, Environment
+from jinja2.lexer import TokenStream
+
+from benchmarks.runner import benchmark, memory_benchmark
+from jinjasql import JinjaSql
+from jinjasql.core import SqlExtension
+
+DATA = {
+    "request": {
+        "project_id": 123,
+        "user_id": "sripathi",
+        "days": ["mon", "tue", "wed", "thu", "fri"],
+        "start_date": "2016-10-10",
+        "end_date": "2016-10-20",
+        "organization": 1321,
+    },
+    "etc": {"columns": "project, timesheet, hours"},
+}
+
+# A realistic report query with control flow, so it always goes
+# through a full render
+REPORT_TEMPLATE = """
+select {{ etc.columns | sqlsafe }}, sum(spend)
+from {{ ('reports', 'transactions') | identifier }}
+where project_id = {{ request.project_id }}
+and start_date > {{ request.start_date }}
+and end_date < {{ request.end_date }}
+{% if request.organization %}
+and organization = {{ request.organization }}
+{% endif %}
+and day in {{ request.days | inclause }}
+{% for day in request.days %}
+and {{ day }} is not null
+{% endfor %}
+group by {{ etc.columns | sqlsafe }}
+"""
+
+# Pure parameter substitution
+SIMPLE_TEMPLATE = """
+select * from timesheet
+where project_id = {{ request.project_id }}
+and user_id = {{ request.user_id }}
+and start_date > {{ request.start_date }}
+"""
+
+
+def _repeated_template(variables):
+    return "select * from t where " + " and ".join(
+        "c%s = {{ request.project_id }}" % i for i in range(variables))
+
+
+@benchmark("filter_stream.200_vars")
+def bench_filter_stream():
+    env = JinjaSql().env
+    source = _repeated_template(200)
+    return lambda: list(env._tokenize(source, None))
+
+
+@benchmark("compile.cold.report")
+def bench_compile_cold():
+    env = JinjaSql().env
+    return lambda: env.from_string(REPORT_TEMPLATE)
+
+
+@benchmark("compile.cold.200_vars")
+def bench_compile_cold_large():
+    env = JinjaSql().env
+    source = _repeated_template(200)
+    return lambda: env.from_string(source)
+
+
+def _register_compile_scaling_benchmarks():
+    """filter_stream alone and a full cold compile, at increasing template
+    sizes. Time per call should grow linearly with the number of variables"""
+    for size in (1000, 10000, 50000):
+        def setup_filter_stream(size=size):
+            env = JinjaSql().env
+            extension = env.extensions[SqlExtension.identifier]
+            tokens = list(env.lexer.tokenize(_repeated_template(size)))
+            return lambda: list(extension.filter_stream(TokenStream(iter(tokens), None, None)))
+        benchmark("filter_stream.scaling.%s_vars" % size)(setup_filter_stream)
+
+    for size in (1000, 10000):
+        def setup_compile(size=size):
+            env = JinjaSql().env
+            source = _repeated_template(size)
+            return lambda: env.from_string(source)
+        benchmark("compile.cold.scaling.%s_vars" % size)(setup_compile)
+
+_register_compile_scaling_benchmarks()
+
+
+@benchmark("prepare_query.uncached.report")
+def bench_prepare_uncached():
+    j = JinjaSql(cache_size=0)
+    return lambda: j.prepare_query(REPORT_TEMPLATE, DATA)
+
+
+def _register_param_style_benchmarks():
+    for param_style in JinjaSql.VALID_PARAM_STYLES:
+        for name, source in (("report", REPORT_TEMPLATE), ("simple", SIMPLE_TEMPLATE)):
+            def setup(param_style=param_style, source=source):
+                j = JinjaSql(param_style=param_style)
+                j.prepare_query(source, DATA)
+                return lambda: j.prepare_query(source, DATA)
+            benchmark("render.warm.%s.%s" % (name, param_style))(setup)
+
+_register_param_style_benchmarks()
+
+
+def _register_inclause_benchmarks():
+    for size in (10, 1000, 100000):
+        def setup(size=size):
+            j = JinjaSql()
+            source = "select * from t where id in {{ ids | inclause }}"
+            data = {"ids": list(range(size))}
+            return lambda: j.prepare_query(source, data)
+        benchmark("inclause.%s" % size)(setup)
+
+_register_inclause_benchmarks()
+
+
+@benchmark("bind.5000_values")
+def bench_bind_throughput():
+    j = JinjaSql()
+    source = "{% for v in values %}{{ v }},{% endfor %}"
+    data = {"values": list(range(5000))}
+    return lambda: j.prepare_query(source, data)
+
+
+def _macro_graph(depth):
+    """Templates where each level imports a macro and includes the next level"""
+    templates = {
+        "macros.sql": (
+            "{% macro where_eq(column, value) %}{{ column | sqlsafe }} = {{ value }}{% endmacro %}"
+        )
+    }
+    for level in range(depth):
+        next_level = "{%% include 'level_%s.sql' %%}" % (level + 1) if level + 1 < depth else ""
+        templates["level_%s.sql" % level] = (
+            "{%% import 'macros.sql' as m %%}\n"
+            "and {{ m.where_eq('c%s', request.project_id) }}\n"
+            "%s" % (level, next_level)
+        )
+    return templates
+
+
+@benchmark("render.warm.macro_include_depth_20")
+def bench_macro_graph():
+    j = JinjaSql(Environment(loader=DictLoader(_macro_graph(20))))
+    source = "select * from t where 1 = 1 {% include 'level_0.sql' %}"
+    j.prepare_query(source, DATA)
+    return lambda: j.prepare_query(source, DATA)
+
+
+@benchmark("render.warm.report.8_threads_x_50")
+def bench_multithreaded():
+    j = JinjaSql()
+    j.prepare_query(REPORT_TEMPLATE, DATA)
+
+    def worker():
+        for _ in range(50):
+            j.prepare_query(REPORT_TEMPLATE, DATA)
+
+    def run():
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return run
+
+
+def _register_memory_benchmarks():
+    """Bind parameter containers for a query with 100000 parameters"""
+    source = "select * from t where id in {{ ids | inclause }}"
+    data = {"ids": list(range(100000))}
+    for name, options in (("format", dict(param_style="format")),
+                          ("named", dict(param_style="named")),
+                          ("named.compact", dict(param_style="named", compact_params=True))):
+        def setup(options=options):
+            j = JinjaSql(**options)
+            j.prepare_query(source, {"ids": [1]})
+            return lambda: j.prepare_query(source, data)
+        memory_benchmark("memory.inclause_100000.%s" % name)(setup)
+
+_register_memory_benchmarks()
@@ -0,0 +1,41 @@
+"""Benchmarks for import time and the cost of creating a JinjaSql.
+
+The startup benchmarks run a new interpreter each time, so compare them
+with startup.python, which is the cost of the interpreter alone.
+"""
+import subprocess
+import sys
+
+from benchmarks.runner import benchmark
+from jinjasql import JinjaSql
+
+
+def _run_python(code):
+    command = [sys.executable, "-c", code]
+    return lambda: subprocess.check_call(command)
+
+
+@benchmark("startup.python")
+def bench_python_startup():
+    return _run_python("pass")
+
+
+@benchmark("startup.import_jinjasql")
+def bench_import():
+    return _run_python("import jinjasql")
+
+
+@benchmark("startup.first_query")
+def bench_first_query():
+    return _run_python(
+        "from jinjasql import JinjaSql; JinjaSql().prepare_query('select {{ a }}', {'a': 1})")
+
+
+@benchmark("construct.default")
+def bench_construct():
+    return lambda: JinjaSql()
+
+
+@benchmark("construct.shared_environment")
+def bench_construct_shared():
+    return lambda: JinjaSql(share_environment=True)
@@ -0,0 +1,154 @@
+"""Minimal benchmark runner.
+
+A benchmark is a function that does its setup and returns a callable
+with no arguments. The runner calls it repeatedly, records the time per
+call, and can save the results as JSON and compare them with a previous run.
+Memory benchmarks are set up the same way, but their callable is run once
+while tracemalloc records the memory it allocates.
+"""
+import gc
+import json
+import platform
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+_BENCHMARKS = OrderedDict()
+_MEMORY_BENCHMARKS = OrderedDict()
+
+
+def benchmark(name):
+    """Decorator to register a benchmark"""
+    def register(func):
+        _BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def memory_benchmark(name):
+    """Decorator to register a memory benchmark"""
+    def register(func):
+        _MEMORY_BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def _calibrate(func, min_time):
+    """Returns how many calls of func take at least min_time seconds"""
+    number = 1
+    while True:
+        elapsed = _time(func, number)
+        if elapsed >= min_time:
+            return number
+        if elapsed == 0:
+            number *= 10
+        else:
+            number = max(number * 2, int(number * min_time / elapsed * 1.2))
+
+
+def _time(func, number):
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        return time.perf_counter() - start
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def run(name_filter=None, repeat=5, min_time=0.2, out=sys.stdout):
+    results = OrderedDict()
+    for name, setup in _BENCHMARKS.items():
+        if name_filter and name_filter not in name:
+            continue
+        func = setup()
+        number = _calibrate(func, min_time)
+        timings = sorted(_time(func, number) / number for _ in range(repeat))
+        results[name] = {
+            "min": timings[0],
+            "median": timings[len(timings) // 2],
+            "number": number,
+            "repeat": repeat,
+        }
+        out.write("%-45s %12s  (median %s)\n" % (
+            name, _format_time(timings[0]), _format_time(results[name]["median"])))
+    return results
+
+
+def run_memory(name_filter=None, out=sys.stdout):
+    """Records the peak memory allocated while each memory benchmark runs,
+    and the memory still held while its return value is alive"""
+    import tracemalloc
+    results = OrderedDict()
+    for name, setup in _MEMORY_BENCHMARKS.items():
+        if name_filter and name_filter not in name:
+            continue
+        func = setup()
+        gc.collect()
+        tracemalloc.start()
+        try:
+            result = func()
+            retained, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        del result
+        results[name] = {"peak": peak, "retained": retained}
+        out.write("%-45s %12s  (retained %s)\n" % (
+            name, _format_bytes(peak), _format_bytes(retained)))
+    return results
+
+
+def metadata():
+    import jinja2
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "jinja2": jinja2.__version__,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def save(results, path):
+    with open(path, "w") as f:
+        json.dump({"metadata": metadata(), "results": results}, f, indent=2)
+
+
+def compare(results, path, out=sys.stdout):
+    """Prints the change in minimum time against a saved run"""
+    with open(path) as f:
+        baseline = json.load(f)
+    out.write("\nCompared to %s (commit %s)\n" % (path, baseline["metadata"].get("commit")))
+    for name, result in results.items():
+        previous = baseline["results"].get(name)
+        if previous is None:
+            out.write("%-45s %12s\n" % (name, "new"))
+            continue
+        metric, format_value = ("min", _format_time) if "min" in result else ("peak", _format_bytes)
+        ratio = result[metric] / previous[metric]
+        out.write("%-45s %12s -> %-12s %6.2fx\n" % (
+            name, format_value(previous[metric]), format_value(result[metric]), ratio))
+
+
+def _format_time(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e3), ("us", 1e6)):
+        if seconds * scale >= 1:
+            return "%.3f %s" % (seconds * scale, unit)
+    return "%.1f ns" % (seconds * 1e9)
+
+
+def _format_bytes(size):
+    for unit, scale in (("MB", 1 << 20), ("kB", 1 << 10)):
+        if size >= scale:
+            return "%.2f %s" % (size / float(scale), unit)
+    return "%d B" % size
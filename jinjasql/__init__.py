@@ -1,6 +1,18 @@
-from jinjasql.core import JinjaSql 
+import sys
 
 __version__ = '0.1.8'
 VERSION = tuple(map(int, __version__.split('.')))
 
 __all__ = ['JinjaSql']
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        # jinja2 is only imported once JinjaSql is first used, so that
+        # tools which import jinjasql but don't render anything start quickly
+        if name == 'JinjaSql':
+            from jinjasql.core import JinjaSql
+            globals()['JinjaSql'] = JinjaSql
+            return JinjaSql
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+else:
+    from jinjasql.core import JinjaSql
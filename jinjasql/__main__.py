@@ -0,0 +1,4 @@
+import sys
+from jinjasql.cli import main
+
+sys.exit(main())
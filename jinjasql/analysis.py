@@ -0,0 +1,98 @@
+"""Static analysis of JinjaSQL templates, see JinjaSql.analyze"""
+from collections import namedtuple
+
+from jinja2 import meta, nodes
+
+# bind_params are the names given to bound values, in the order they
+# first appear in the template. in_clauses, any_clauses, identifiers and
+# sqlsafe are the data paths passed to those filters, with None for
+# arguments that are not a plain variable or attribute lookup.
+# data_paths is the set of dotted paths the template reads from data,
+# such as 'request.project_id'. Only the template itself is analyzed,
+# not the macros it imports or the templates it includes.
+TemplateAnalysis = namedtuple('TemplateAnalysis', [
+    'bind_params', 'in_clauses', 'any_clauses', 'identifiers', 'sqlsafe', 'data_paths'])
+
+# Filters whose output is never bound
+_SAFE_FILTERS = ('identifier', 'sqlsafe')
+
+_USAGE_FILTERS = {
+    'inclause': 'in_clauses',
+    'anyclause': 'any_clauses',
+    'identifier': 'identifiers',
+    'sqlsafe': 'sqlsafe',
+}
+
+
+def analyze_ast(ast):
+    """Returns the TemplateAnalysis of a template parsed by a JinjaSql environment"""
+    undeclared = meta.find_undeclared_variables(ast)
+    # Calling a macro produces SQL, not a value to bind
+    macros = set(node.name for node in ast.find_all(nodes.Macro))
+    macros.update(node.target for node in ast.find_all(nodes.Import))
+    for node in ast.find_all(nodes.FromImport):
+        macros.update(name if isinstance(name, str) else name[1] for name in node.names)
+
+    bind_params = []
+    usages = dict((field, []) for field in _USAGE_FILTERS.values())
+    for node in ast.find_all(nodes.Filter):
+        if node.name == 'bind':
+            if _is_bound(node.node, macros) and node.args and isinstance(node.args[0], nodes.Const):
+                if node.args[0].value not in bind_params:
+                    bind_params.append(node.args[0].value)
+        elif node.name in _USAGE_FILTERS:
+            path = _data_path(node.node)
+            usages[_USAGE_FILTERS[node.name]].append(
+                '.'.join(path) if path is not None else None)
+
+    data_paths = set()
+    _collect_data_paths(ast, undeclared, data_paths)
+
+    return TemplateAnalysis(
+        bind_params=tuple(bind_params),
+        in_clauses=tuple(usages['in_clauses']),
+        any_clauses=tuple(usages['any_clauses']),
+        identifiers=tuple(usages['identifiers']),
+        sqlsafe=tuple(usages['sqlsafe']),
+        data_paths=frozenset(data_paths))
+
+
+def _is_bound(node, macros):
+    if isinstance(node, nodes.Filter) and node.name in _SAFE_FILTERS:
+        return False
+    if isinstance(node, nodes.Call):
+        path = _data_path(node.node)
+        if path is not None and path[0] in macros:
+            return False
+    return True
+
+
+def _data_path(node):
+    """Returns ('a', 'b', 'c') for expressions like a.b.c or a['b'].c,
+    or None for any other expression"""
+    path = []
+    while True:
+        if isinstance(node, nodes.Getattr):
+            path.append(node.attr)
+        elif (isinstance(node, nodes.Getitem) and isinstance(node.arg, nodes.Const)
+              and isinstance(node.arg.value, str)):
+            path.append(node.arg.value)
+        else:
+            break
+        node = node.node
+    if not isinstance(node, nodes.Name):
+        return None
+    path.append(node.name)
+    path.reverse()
+    return tuple(path)
+
+
+def _collect_data_paths(node, undeclared, data_paths):
+    if isinstance(node, (nodes.Getattr, nodes.Getitem, nodes.Name)):
+        path = _data_path(node)
+        if path is not None:
+            if path[0] in undeclared and node.ctx == 'load':
+                data_paths.add('.'.join(path))
+            return
+    for child in node.iter_child_nodes():
+        _collect_data_paths(child, undeclared, data_paths)
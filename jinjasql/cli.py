@@ -0,0 +1,30 @@
+"""Command line interface, installed as the `jinjasql` script"""
+import argparse
+import sys
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="jinjasql")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    compile_command = commands.add_parser(
+        "compile", help="precompile a directory of templates into python modules")
+    compile_command.add_argument("source", help="directory containing the templates")
+    compile_command.add_argument("target", help="directory to write the compiled modules to")
+    compile_command.add_argument(
+        "-e", "--extension", action="append", dest="extensions",
+        help="only compile templates with this file extension, can be repeated")
+    compile_command.add_argument("-q", "--quiet", action="store_true")
+
+    args = parser.parse_args(argv)
+    if args.command == "compile":
+        from jinjasql.precompile import precompile_templates
+        log_function = None if args.quiet else (lambda message: sys.stderr.write(message + "\n"))
+        precompile_templates(args.source, args.target, extensions=args.extensions,
+                             log_function=log_function)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
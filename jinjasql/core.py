@@ -1,24 +1,56 @@
 from __future__ import unicode_literals
 from jinja2 import Environment
+from jinja2 import ChoiceLoader, ModuleLoader
 from jinja2 import Template
+from jinja2 import nodes
 from jinja2.ext import Extension
 from jinja2.lexer import Token
-from jinja2.utils import Markup
-from collections.abc import Iterable
+from markupsafe import Markup
+from jinjasql.instrumentation import RenderEvent
+from collections.abc import Iterable, Mapping
+from datetime import date, datetime, time
+from decimal import Decimal
 
+from collections import OrderedDict, namedtuple
+from hashlib import md5, sha1
 try:
-    from collections import OrderedDict
+    from hashlib import blake2b
 except ImportError:
-    # For Python 2.6 and less
-    from ordereddict import OrderedDict
+    # Python 3.5. Fingerprints then differ from those of later versions
+    blake2b = None
+from threading import local, Lock
+from itertools import islice
+from time import perf_counter
+import re
+import sys
+import weakref
 
-from threading import local
-from random import Random
+try:
+    from contextvars import ContextVar
+    _HAS_CONTEXTVARS = True
+except ImportError:
+    # For Python 3.6 and less. There is no asyncio context to follow,
+    # so the state simply lives in a thread local, and concurrent async
+    # renders would share it
+    _HAS_CONTEXTVARS = False
+
+    class ContextVar(local):
+        def __init__(self, name):
+            self.name = name
 
-_thread_local = local()
+        def get(self):
+            try:
+                return self.value
+            except AttributeError:
+                raise LookupError(self.name)
 
-# This is mocked in unit tests for deterministic behaviour
-random = Random()
+        def set(self, value):
+            token = getattr(self, 'value', None)
+            self.value = value
+            return token
+
+        def reset(self, token):
+            self.value = token
 
 
 class JinjaSqlException(Exception):
@@ -27,22 +59,57 @@ class JinjaSqlException(Exception):
 class InvalidBindParameterException(JinjaSqlException):
     pass
 
+class InconsistentQueryException(JinjaSqlException):
+    """Raised by prepare_many when rows render to different SQL"""
+    pass
+
+class QueryLimitExceededException(JinjaSqlException):
+    """Raised while rendering when a query goes over one of the limits
+    set with max_bind_params, max_inclause_size or max_query_length"""
+    pass
+
+# Filters whose output is not passed through bind again
+_NO_BIND_FILTERS = frozenset(('bind', 'inclause', 'anyclause', 'sqlsafe'))
+
+class _BindTokens(object):
+    """The constant tokens that filter_stream adds around every variable
+    expression, built once per line number and shared. Lines after
+    MAX_CACHED_LINENO get new tokens every time, so that huge generated
+    templates don't pin memory"""
+    MAX_CACHED_LINENO = 8192
+
+    def __init__(self):
+        self._tokens = [None]
+
+    def __call__(self, lineno):
+        if lineno > self.MAX_CACHED_LINENO:
+            return self._build(lineno)
+        tokens = self._tokens
+        if lineno >= len(tokens):
+            tokens.extend([None] * (lineno + 1 - len(tokens)))
+        cached = tokens[lineno]
+        if cached is None:
+            cached = tokens[lineno] = self._build(lineno)
+        return cached
+
+    @staticmethod
+    def _build(lineno):
+        return (Token(lineno, 'lparen', u'('), Token(lineno, 'rparen', u')'),
+                Token(lineno, 'pipe', u'|'), Token(lineno, 'name', u'bind'))
+
+_bind_tokens = _BindTokens()
+
 class SqlExtension(Extension):
 
     def extract_param_name(self, tokens):
-        name = ""
+        parts = []
         for token in tokens:
-            if token.test("variable_begin"):
-                continue
-            elif token.test("name"):
-                name += token.value
-            elif token.test("dot"):
-                name += token.value
-            else:
+            token_type = token.type
+            if token_type == "name" or token_type == "dot":
+                parts.append(token.value)
+            elif token_type != "variable_begin":
                 break
-        if not name:
-            name = "bind#0"
-        return name
+        return "".join(parts) or "bind#0"
 
     def filter_stream(self, stream):
         """
@@ -61,39 +128,209 @@ class SqlExtension(Extension):
         """
         while not stream.eos:
             token = next(stream)
-            if token.test("variable_begin"):
-                var_expr = []
-                while not token.test("variable_end"):
-                    var_expr.append(token)
-                    token = next(stream)
-                variable_end = token
-
-                last_token = var_expr[-1]
-                lineno = last_token.lineno
-                # don't bind twice
-                if (not last_token.test("name") 
-                    or not last_token.value in ('bind', 'inclause', 'sqlsafe')):
-                    param_name = self.extract_param_name(var_expr)
-                    
-                    var_expr.insert(1, Token(lineno, 'lparen', u'('))
-                    var_expr.append(Token(lineno, 'rparen', u')'))
-                    var_expr.append(Token(lineno, 'pipe', u'|'))
-                    var_expr.append(Token(lineno, 'name', u'bind'))
-                    var_expr.append(Token(lineno, 'lparen', u'('))
-                    var_expr.append(Token(lineno, 'string', param_name))
-                    var_expr.append(Token(lineno, 'rparen', u')'))
-
-                var_expr.append(variable_end)
-                for token in var_expr:
-                    yield token
-            else:
+            if token.type != "variable_begin":
                 yield token
+                continue
+
+            variable_begin = token
+            var_expr = []
+            token = next(stream)
+            while token.type != "variable_end":
+                var_expr.append(token)
+                token = next(stream)
+
+            last_token = var_expr[-1] if var_expr else variable_begin
+            yield variable_begin
+            # don't bind twice
+            if last_token.type == "name" and last_token.value in _NO_BIND_FILTERS:
+                for expr_token in var_expr:
+                    yield expr_token
+            else:
+                lineno = last_token.lineno
+                lparen, rparen, pipe, bind_name = _bind_tokens(lineno)
+                yield lparen
+                for expr_token in var_expr:
+                    yield expr_token
+                yield rparen
+                yield pipe
+                yield bind_name
+                yield lparen
+                yield Token(lineno, 'string', self.extract_param_name(var_expr))
+                yield rparen
+            yield token
 
 def sql_safe(value):
     """Filter to mark the value of an expression as safe for inserting
     in a SQL statement"""
     return Markup(value)
 
+class _IndexedPlaceholders(object):
+    """Placeholders like :1 or $1 that only depend on the parameter index.
+    The strings are built once and shared by every render, up to
+    MAX_CACHED. Larger indexes are formatted every time, so that one huge
+    query doesn't pin its placeholders for the life of the process"""
+    MAX_CACHED = 4096
+
+    def __init__(self, fmt):
+        self.fmt = fmt
+        self.table = [fmt % i for i in range(256)]
+
+    def __call__(self, index, key):
+        try:
+            return self.table[index]
+        except IndexError:
+            return self._grow(index)
+
+    def _grow(self, index):
+        if index >= self.MAX_CACHED:
+            return self.fmt % index
+        # Readers may be using the old table from other threads,
+        # so build a new list and swap it in
+        table = self.table
+        size = min(max(index + 1, 2 * len(table)), self.MAX_CACHED)
+        self.table = table + [self.fmt % i for i in range(len(table), size)]
+        return self.table[index]
+
+def _qmark_placeholder(index, key):
+    return "?"
+
+def _format_placeholder(index, key):
+    return "%s"
+
+def _named_placeholder(index, key):
+    return ":" + key
+
+def _pyformat_placeholder(index, key):
+    return "%(" + key + ")s"
+
+_PLACEHOLDERS = {
+    'qmark': _qmark_placeholder,
+    'format': _format_placeholder,
+    'numeric': _IndexedPlaceholders(":%s"),
+    'named': _named_placeholder,
+    'pyformat': _pyformat_placeholder,
+    'asyncpg': _IndexedPlaceholders("$%s"),
+}
+
+# Param styles where bind parameters are passed as a list
+_POSITIONAL_STYLES = frozenset(('qmark', 'numeric', 'format', 'asyncpg'))
+
+# Param styles where a placeholder can refer to the same parameter twice
+_REUSABLE_STYLES = frozenset(('numeric', 'named', 'pyformat', 'asyncpg'))
+
+class NamedParams(Mapping):
+    """Bind parameters for named param styles, returned instead of a dict
+    when JinjaSql is created with compact_params=True.
+
+    Names and values are kept in two lists. Keys such as 'project_id_3' are
+    only built when the mapping is iterated, and looking up a key parses
+    its index, so a query with many parameters doesn't hold a string and 
+    a hash table entry for every one of them. Use dict(params) for drivers
+    that only accept a dict.
+    """
+    __slots__ = ('_names', '_values', '_start')
+
+    def __init__(self, start=1):
+        self._names = []
+        self._values = []
+        # The parameter index of the first value
+        self._start = start
+
+    def _add(self, name, value):
+        self._names.append(name)
+        self._values.append(value)
+
+    def _truncate(self, param_index):
+        keep = param_index - self._start + 1
+        del self._names[keep:]
+        del self._values[keep:]
+
+    def __getitem__(self, key):
+        if not isinstance(key, str):
+            raise KeyError(key)
+        name, separator, index = key.rpartition("_")
+        if not separator or not index.isdigit():
+            raise KeyError(key)
+        # Only the keys that iteration produces, so not 'a_01'
+        param_index = int(index)
+        if str(param_index) != index:
+            raise KeyError(key)
+        position = param_index - self._start
+        if not 0 <= position < len(self._values) or self._names[position] != name:
+            raise KeyError(key)
+        return self._values[position]
+
+    def __iter__(self):
+        for position, name in enumerate(self._names, self._start):
+            yield "%s_%s" % (name, position)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return "NamedParams(%r)" % (dict(self),)
+
+class _BindState(object):
+    """Parameters bound while rendering one query. bind_params is a list
+    for positional param styles, and a dict or NamedParams for named
+    param styles"""
+    __slots__ = ('bind_params', 'placeholder', 'positional', 'compact', 'param_index',
+                 'in_clause_bucketing', 'in_clause_count', 'seen',
+                 'adapter_cache', 'resolve_adapter', 'max_bind_params', 'max_inclause_size',
+                 'hasher')
+
+    def __init__(self, placeholder, positional, in_clause_bucketing=None, deduplicate=False,
+                 adapter_cache=None, resolve_adapter=None, max_bind_params=None,
+                 max_inclause_size=None, compact=False):
+        self.placeholder = placeholder
+        self.positional = positional
+        self.compact = compact and not positional
+        self.bind_params = self.new_params(1)
+        # type -> adapter or None, see JinjaSql.register_adapter
+        self.adapter_cache = adapter_cache
+        self.resolve_adapter = resolve_adapter
+        self.param_index = 0
+        self.in_clause_bucketing = in_clause_bucketing
+        self.in_clause_count = 0
+        # (param name, value) -> (placeholder, param index, value) of values
+        # already bound, when repeated values should reuse their placeholder.
+        # The value is the one before adapters, which bind_params may not hold
+        self.seen = {} if deduplicate else None
+        self.max_bind_params = max_bind_params
+        self.max_inclause_size = max_inclause_size
+        # Hashes every bound value when the query is fingerprinted
+        self.hasher = None
+
+    def new_params(self, start):
+        """Returns an empty container for parameters numbered from start"""
+        if self.positional:
+            return []
+        return NamedParams(start) if self.compact else {}
+
+    def truncate(self, param_index):
+        """Forgets the parameters bound after param_index"""
+        if self.positional:
+            del self.bind_params[param_index:]
+        elif self.compact:
+            self.bind_params._truncate(param_index)
+        else:
+            # Keys end with their parameter index. Deleted by name, since
+            # dicts before Python 3.6 don't keep the order of insertion
+            for key in [key for key in self.bind_params
+                        if int(key.rpartition("_")[2]) > param_index]:
+                del self.bind_params[key]
+        self.param_index = param_index
+        if self.seen:
+            self.seen = dict((key, bound) for key, bound in self.seen.items()
+                             if bound[1] <= param_index)
+
+# The _BindState of the query being rendered. A context variable keeps
+# renders in different threads and asyncio tasks apart, follows a render
+# across the awaits of its task, and also reaches macros imported without
+# context. Threads started during a render don't see it, since new threads
+# begin with an empty context
+_bind_state = ContextVar('jinjasql_bind_state')
+
 def bind(value, name):
     """A filter that prints %s, and stores the value 
     in an array, so that it can be bound using a prepared statement
@@ -104,38 +341,155 @@ def bind(value, name):
     if isinstance(value, Markup):
         return value
     else:
-        return _bind_param(_thread_local.bind_params, name, value)
+        return _bind_param(_bind_state.get(), name, value)
     
 def bind_in_clause(value):
-    values = list(value)
+    state = _bind_state.get()
+    state.in_clause_count += 1
+    values = _limited_list(value, state.max_inclause_size)
+    if state.in_clause_bucketing and values:
+        _pad_to_bucket(values, state.in_clause_bucketing)
+        # The padded list is what gets bound
+        _check_inclause_size(values, state.max_inclause_size)
     results = []
     for v in values:
-        results.append(_bind_param(_thread_local.bind_params, "inclause", v))
+        # Never deduplicated, so that the text of the clause only
+        # depends on the number of values
+        results.append(_bind_param(state, "inclause", v, False))
     
     clause = ",".join(results)
     clause = "(" + clause + ")"
     return clause
 
-def _bind_param(already_bound, key, value):
-    _thread_local.param_index += 1
-    new_key = "%s_%s" % (key, _thread_local.param_index)
-    already_bound[new_key] = value
-    
-    param_style = _thread_local.param_style
-    if param_style == 'qmark':
-        return "?"
-    elif param_style == 'format':
-        return "%s"
-    elif param_style == 'numeric':
-        return ":%s" % _thread_local.param_index
-    elif param_style == 'named':
-        return ":%s" % new_key
-    elif param_style == 'pyformat':
-        return "%%(%s)s" % new_key
-    elif param_style == 'asyncpg':
-        return "$%s" % _thread_local.param_index
+def _pad_to_bucket(values, bucketing):
+    """Pads values to the next power of two, so that lists of
+    different lengths share a small number of distinct queries.
+    Padding with None breaks NOT IN, see VALID_IN_CLAUSE_BUCKETING"""
+    bucket_size = 1 << (len(values) - 1).bit_length()
+    padding = values[-1] if bucketing == 'repeat' else None
+    values.extend([padding] * (bucket_size - len(values)))
+
+def _limited_list(value, limit):
+    """Returns list(value), but raises as soon as value turns out to have
+    more than limit elements, without copying all of them"""
+    if limit is None:
+        return list(value)
+    if hasattr(value, '__len__'):
+        _check_inclause_size(value, limit)
+        return list(value)
+    values = list(islice(value, limit + 1))
+    _check_inclause_size(values, limit)
+    return values
+
+def _check_inclause_size(values, limit):
+    if limit is not None and len(values) > limit:
+        raise QueryLimitExceededException(
+            "An in clause has more than max_inclause_size=%s values" % limit)
+
+def bind_any_clause(value):
+    """A filter that binds a list as a single array parameter, 
+    for use as `where id = {{ ids | anyclause }}`. The query text
+    is the same no matter how many elements the list has"""
+    state = _bind_state.get()
+    if hasattr(value, 'tolist'):
+        _check_inclause_size(value, state.max_inclause_size)
+        values = value.tolist()
+    else:
+        values = _limited_list(value, state.max_inclause_size)
+    return "ANY(" + _bind_param(state, "anyclause", values) + ")"
+
+def _bind_param(state, key, value, deduplicate=True):
+    seen = state.seen if deduplicate else None
+    if seen is not None:
+        try:
+            seen_key = (key, type(value), value)
+            bound = seen.get(seen_key)
+        except TypeError:
+            # Unhashable values can only be matched by identity. The entry
+            # keeps the value alive, so its id can't be reused meanwhile
+            seen_key = (key, id(value))
+            bound = seen.get(seen_key)
+        if bound is not None:
+            return bound[0]
+        original = value
+
+    adapter_cache = state.adapter_cache
+    if adapter_cache is not None:
+        try:
+            adapter = adapter_cache[type(value)]
+        except KeyError:
+            adapter = state.resolve_adapter(type(value))
+        if adapter is not None:
+            value = adapter(value)
+
+    if state.param_index == state.max_bind_params:
+        raise QueryLimitExceededException(
+            "The query binds more than max_bind_params=%s parameters" % state.max_bind_params)
+    state.param_index += 1
+    if state.positional:
+        state.bind_params.append(value)
+        placeholder = state.placeholder(state.param_index, None)
+    elif state.compact:
+        state.bind_params._add(key, value)
+        placeholder = state.placeholder(state.param_index, "%s_%s" % (key, state.param_index))
+    else:
+        new_key = "%s_%s" % (key, state.param_index)
+        state.bind_params[new_key] = value
+        placeholder = state.placeholder(state.param_index, new_key)
+
+    if seen is not None:
+        seen[seen_key] = (placeholder, state.param_index, original)
+    if state.hasher is not None:
+        _hash_value(state.hasher, value)
+    return placeholder
+
+def _hash_value(hasher, value):
+    """Adds a bound value to a fingerprint. Values are hashed by their repr,
+    except for those whose repr doesn't show all of their content"""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        data = bytes(value)
+        hasher.update(("%s %s\x00" % (type(value).__name__, len(data))).encode('utf-8'))
+        hasher.update(data)
+    elif hasattr(value, 'dtype') and hasattr(value, 'tobytes'):
+        # numpy arrays and scalars. Large arrays have a shortened repr
+        if value.dtype.hasobject:
+            hasher.update(("%s %r\x00" % (type(value).__name__, value.shape)).encode('utf-8'))
+            _hash_value(hasher, value.tolist())
+        else:
+            data = value.tobytes()
+            hasher.update(("%s %s %r %s\x00" % (type(value).__name__, value.dtype.str,
+                                                 value.shape, len(data))).encode('utf-8'))
+            hasher.update(data)
+    elif isinstance(value, (list, tuple)):
+        hasher.update(("%s %s\x00" % (type(value).__name__, len(value))).encode('utf-8'))
+        for item in value:
+            _hash_value(hasher, item)
+    elif type(value).__repr__ is object.__repr__:
+        # The default repr only has the address, which says nothing about the value
+        raise JinjaSqlException("Can't fingerprint a %s, it has no repr showing its value"
+                                % type(value).__name__)
     else:
-        raise AssertionError("Invalid param_style - %s" % param_style)
+        hasher.update(("%r\x00" % (value,)).encode('utf-8'))
+
+def _adapt_numpy_array(value):
+    """1-D arrays become a single list parameter, which drivers bind as an array"""
+    return value.tolist() if value.ndim == 1 else value
+
+def _adapt_numpy_scalar(value):
+    return value.item()
+
+# Adapters for optional libraries are keyed on "module.QualifiedName",
+# so that the library doesn't have to be imported to register them
+DEFAULT_ADAPTERS = {
+    'numpy.ndarray': _adapt_numpy_array,
+    'numpy.generic': _adapt_numpy_scalar,
+}
+
+# Types looked up when the adapter cache is created, so that the common
+# cases never walk the MRO. Without a registered adapter they are bound 
+# as is - bytes and memoryview are never copied
+_PRELOADED_TYPES = (str, int, float, bool, type(None), bytes, bytearray, memoryview,
+                    date, datetime, time, Decimal)
 
 def build_escape_identifier_filter(identifier_quote_character):
     def quote_and_escape(value):
@@ -160,6 +514,199 @@ def requires_in_clause(obj):
 def is_dictionary(obj):
     return isinstance(obj, dict)
 
+# Names that jinja resolves specially at the top level of a template,
+# so they cannot be looked up directly in the render context
+_SPECIAL_NAMES = frozenset(('self', 'super', 'loop', 'caller', 'varargs', 'kwargs'))
+
+class _QueryPlan(object):
+    """Precomputed form of a template that only substitutes variables.
+
+    Templates such as `select * from t where id = {{ request.id }}` have
+    no control flow, so the query text is fixed and only the bound values
+    change between calls. A plan keeps the literal text and the attribute
+    path of every variable, so the query can be produced without running
+    the template. The output is identical to template.render()
+    """
+
+    def __init__(self, environment, template, steps, tail):
+        self.environment = environment
+        self.globals = template.globals
+        # List of (literal text, attribute path, bind param name)
+        self.steps = steps
+        self.tail = tail
+
+    @classmethod
+    def build(cls, environment, template, ast):
+        """Returns a plan for the parsed template, or None if the
+        template does anything other than output data and variables"""
+        if environment.finalize is not None or environment.filters.get('bind') is not bind:
+            return None
+
+        steps = []
+        literal = []
+        for output in ast.body:
+            if not isinstance(output, nodes.Output):
+                return None
+            for child in output.nodes:
+                if isinstance(child, nodes.TemplateData):
+                    literal.append(child.data)
+                    continue
+                path = cls._bind_path(child)
+                if path is None:
+                    return None
+                steps.append(("".join(literal), path, child.args[0].value))
+                literal = []
+        return cls(environment, template, steps, "".join(literal))
+
+    @staticmethod
+    def _bind_path(node):
+        """Returns the attribute path of expressions like 
+        {{ (a.b.c) | bind('a.b.c') }} as a tuple ('a', 'b', 'c')"""
+        if not (isinstance(node, nodes.Filter) and node.name == 'bind'
+                and len(node.args) == 1 and isinstance(node.args[0], nodes.Const)
+                and not node.kwargs and node.dyn_args is None and node.dyn_kwargs is None):
+            return None
+        path = []
+        node = node.node
+        while isinstance(node, nodes.Getattr):
+            path.append(node.attr)
+            node = node.node
+        if not isinstance(node, nodes.Name) or node.name in _SPECIAL_NAMES:
+            return None
+        path.append(node.name)
+        path.reverse()
+        return tuple(path)
+
+    def render(self, data):
+        return self.join(self.bind_values(data))
+
+    def bind_values(self, data):
+        """Binds the variables of data in order, and returns the text each
+        of them renders to: a placeholder, or the value itself for Markup"""
+        environment = self.environment
+        getattr_ = environment.getattr
+        globals_ = self.globals
+        outputs = []
+        for _, path, param_name in self.steps:
+            name = path[0]
+            if name in data:
+                value = data[name]
+            elif name in globals_:
+                value = globals_[name]
+            else:
+                value = environment.undefined(name=name)
+            for attr in path[1:]:
+                value = getattr_(value, attr)
+            outputs.append(bind(value, param_name))
+        return outputs
+
+    def join(self, outputs):
+        """Returns the query, given the outputs of bind_values"""
+        parts = []
+        for step, output in zip(self.steps, outputs):
+            parts.append(step[0])
+            parts.append(output)
+        parts.append(self.tail)
+        return "".join(parts)
+
+def _utf8_length(text):
+    return len(text.encode('utf-8'))
+
+class _CompiledQuery(object):
+    """A compiled template, along with its query plan if it has one"""
+    __slots__ = ('template', 'plan', 'source', 'analysis', '_template_hash')
+
+    def __init__(self, template, plan=None, source=None):
+        self.template = template
+        self.plan = plan
+        self.source = source
+        # Filled in by JinjaSql.analyze
+        self.analysis = None
+        self._template_hash = None
+
+    @property
+    def template_hash(self):
+        """A short hash of the template source. Templates that were
+        not compiled from a string don't have one"""
+        if self._template_hash is None and self.source is not None:
+            self._template_hash = sha1(self.source.encode('utf-8')).hexdigest()[:16]
+        return self._template_hash
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize'])
+
+# Returned by prepare_query when JinjaSql is created with fingerprint=True.
+# shape is a hash of the query with whitespace outside of string literals
+# collapsed, and params is a hash of the repr of each bound value, in order
+QueryFingerprint = namedtuple('QueryFingerprint', ['shape', 'params'])
+
+# String literals and quoted identifiers, whose whitespace is kept, or a run of whitespace
+_WHITESPACE_OR_QUOTED = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")|\s+")
+
+def _new_hash(data=b''):
+    """A hash with a 16 byte digest, for fingerprints"""
+    if blake2b is not None:
+        return blake2b(data, digest_size=16)
+    return md5(data)
+
+def _query_shape(query):
+    normalized = _WHITESPACE_OR_QUOTED.sub(lambda match: match.group(1) or " ", query).strip()
+    return _new_hash(normalized.encode('utf-8')).hexdigest()
+
+class _LRUCache(object):
+    """A small thread-safe mapping that evicts the least recently used
+    entry once it holds more than maxsize items. on_evict, if provided,
+    is called with each value that is evicted or cleared"""
+
+    def __init__(self, maxsize, on_evict=None):
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                _, evicted = self._data.popitem(last=False)
+                self.evictions += 1
+                if self.on_evict is not None:
+                    self.on_evict(evicted)
+
+    def clear(self):
+        with self._lock:
+            if self.on_evict is not None:
+                for value in self._data.values():
+                    self.on_evict(value)
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.evictions,
+                             self.maxsize, len(self._data))
+
+# Environments and template caches of JinjaSql instances created with
+# share_environment=True, keyed on the options used to prepare them
+_shared_environments = {}
+_shared_environments_lock = Lock()
+
 class JinjaSql(object):
     # See PEP-249 for definition
     # qmark "where name = ?"
@@ -170,14 +717,95 @@ class JinjaSql(object):
     # asyncpg "where name = $1"
     VALID_PARAM_STYLES = ('qmark', 'numeric', 'named', 'format', 'pyformat', 'asyncpg')
     VALID_ID_QUOTE_CHARS = ('`', '"')
-    def __init__(self, env=None, param_style='format', identifier_quote_character='"'):
+    # None expands in clauses exactly, 'repeat' pads them to a power of 
+    # two with the last value, and 'null' pads them with NULL. Don't use
+    # 'null' with NOT IN: x NOT IN (1, NULL) is never true, so the query
+    # silently returns no rows
+    VALID_IN_CLAUSE_BUCKETING = (None, 'repeat', 'null')
+    def __init__(self, env=None, param_style='format', identifier_quote_character='"',
+                 cache_size=128, in_clause_bucketing=None, observer=None,
+                 precompiled_templates=None, deduplicate_params=False, adapters=None,
+                 max_bind_params=None, max_inclause_size=None, max_query_length=None,
+                 fingerprint=False, share_environment=False, compact_params=False):
+        if param_style not in self.VALID_PARAM_STYLES:
+            raise ValueError("param_style must be one of %s" % (self.VALID_PARAM_STYLES,))
         self.param_style = param_style
+        # Chosen once here, so that binding a value doesn't have to look at param_style
+        self._placeholder = _PLACEHOLDERS[param_style]
+        self._positional = param_style in _POSITIONAL_STYLES
+        # qmark and format placeholders can't refer back to an earlier
+        # parameter, so they always bind every value
+        self.deduplicate_params = deduplicate_params
+        self._deduplicate = deduplicate_params and param_style in _REUSABLE_STYLES
+        # Named param styles return NamedParams instead of a dict
+        self.compact_params = compact_params
+        if in_clause_bucketing not in self.VALID_IN_CLAUSE_BUCKETING:
+            raise ValueError("in_clause_bucketing must be one of %s" % (self.VALID_IN_CLAUSE_BUCKETING,))
+        self.in_clause_bucketing = in_clause_bucketing
         if identifier_quote_character not in self.VALID_ID_QUOTE_CHARS:
             raise ValueError("identifier_quote_characters must be one of " + VALID_ID_QUOTE_CHARS)
         self.identifier_quote_character = identifier_quote_character
-        self.env = env or Environment()
+        # Rendering raises QueryLimitExceededException as soon as a query
+        # goes over one of these. None means no limit
+        self.max_bind_params = max_bind_params
+        self.max_inclause_size = max_inclause_size
+        self.max_query_length = max_query_length
+        if env is None and share_environment:
+            self.env, self._template_cache = self._shared_environment(cache_size, precompiled_templates)
+        else:
+            self._setup_environment(env or Environment(), precompiled_templates)
+            # Templates compiled from strings, keyed on the source text.
+            # A cache_size of 0 or None disables caching
+            self._template_cache = _LRUCache(cache_size) if cache_size else None
+        # When set, prepare_query returns (query, bind_params, QueryFingerprint).
+        # Shapes are cached by a digest of the query, as most queries repeat
+        self.fingerprint = fingerprint
+        self._shapes = _LRUCache(cache_size or 128) if fingerprint else None
+        # See jinjasql.instrumentation. Receives a RenderEvent for every query
+        self.observer = observer
+        self._adapters = dict(DEFAULT_ADAPTERS)
+        if adapters:
+            self._adapters.update(adapters)
+            self._reset_adapter_cache()
+        else:
+            # Instances with the default adapters resolve every type the
+            # same way, so they share one cache instead of each warming its own
+            if JinjaSql._default_adapter_cache is None:
+                self._reset_adapter_cache()
+                JinjaSql._default_adapter_cache = self._adapter_cache
+            self._adapter_cache = JinjaSql._default_adapter_cache
+        # See watch_templates
+        self._watcher = None
+        self._auto_reload = None
+        # See analyze. Loaded templates are replaced when they are reloaded,
+        # so their analysis is dropped along with them
+        self._analyses = weakref.WeakKeyDictionary()
+        # Templates returned by specialize, with their query plans
+        self._specialized = weakref.WeakKeyDictionary()
+
+    _default_adapter_cache = None
+
+    def _setup_environment(self, env, precompiled_templates):
+        self.env = env
+        if precompiled_templates is not None:
+            # Templates compiled by jinjasql.precompile are loaded first,
+            # anything else falls back to the environment's own loader
+            modules = ModuleLoader(precompiled_templates)
+            env.loader = ChoiceLoader([modules, env.loader]) if env.loader else modules
         self._prepare_environment()
 
+    def _shared_environment(self, cache_size, precompiled_templates):
+        """Returns the (environment, template cache) shared by instances
+        created with share_environment=True and the same options"""
+        key = (self.identifier_quote_character, cache_size, precompiled_templates)
+        with _shared_environments_lock:
+            shared = _shared_environments.get(key)
+            if shared is None:
+                self._setup_environment(Environment(), precompiled_templates)
+                shared = (self.env, _LRUCache(cache_size) if cache_size else None)
+                _shared_environments[key] = shared
+        return shared
+
     def _prepare_environment(self):
         self.env.autoescape=True
         self.env.add_extension(SqlExtension)
@@ -185,29 +813,598 @@ class JinjaSql(object):
         self.env.filters["bind"] = bind
         self.env.filters["sqlsafe"] = sql_safe
         self.env.filters["inclause"] = bind_in_clause
+        self.env.filters["anyclause"] = bind_any_clause
         self.env.filters["identifier"] = build_escape_identifier_filter(self.identifier_quote_character)
 
     def prepare_query(self, source, data):
+        if self.observer is None:
+            return self._prepare_query(self._get_compiled(source), data,
+                                       fingerprint=self.fingerprint)
+
+        start = perf_counter()
+        compiled = self._get_compiled(source)
+        return self._prepare_query(compiled, data, perf_counter() - start, self.fingerprint)
+
+    def prepare_queries(self, jobs, executor=None):
+        """Prepares a query for every (source, data) pair in jobs, and returns
+        a list of (query, bind_params) in the same order.
+
+        If executor is a concurrent.futures.ThreadPoolExecutor (or any
+        executor that runs callables in this process), the queries are
+        prepared in parallel. JinjaSql is thread safe, so all threads share
+        this object and its template cache. To use several cores, pass a pool
+        created with process_pool() instead.
+        """
+        if executor is None:
+            return [self.prepare_query(source, data) for source, data in jobs]
+
+        from concurrent.futures import ProcessPoolExecutor
+        from jinjasql.pool import RenderProcessPool
+        if isinstance(executor, RenderProcessPool):
+            return executor.prepare_queries(jobs)
+        if isinstance(executor, ProcessPoolExecutor):
+            raise ValueError("Templates can't be sent to a plain ProcessPoolExecutor, "
+                             "create the pool with JinjaSql.process_pool() instead")
+        return list(executor.map(self._prepare_job, jobs))
+
+    def _prepare_job(self, job):
+        source, data = job
+        return self.prepare_query(source, data)
+
+    def process_pool(self, sources=(), max_workers=None):
+        """Returns a process pool for prepare_queries. The template strings
+        in sources are compiled once here and sent to every worker as it
+        starts, so jobs only carry their data. Other template strings are
+        compiled by the worker the first time it sees them. 
+
+        Workers use a new Environment with the same loader as this one,
+        and don't call the observer. Needs Python 3.7 or later.
+        """
+        if sys.version_info < (3, 7):
+            # ProcessPoolExecutor only takes an initializer since 3.7
+            raise JinjaSqlException("process_pool needs Python 3.7 or later")
+        from jinjasql.pool import RenderProcessPool
+        return RenderProcessPool(self, sources, max_workers)
+
+    def _worker_options(self):
+        """Constructor arguments for the JinjaSql in process pool workers"""
+        return dict(
+            param_style=self.param_style,
+            identifier_quote_character=self.identifier_quote_character,
+            in_clause_bucketing=self.in_clause_bucketing,
+            deduplicate_params=self.deduplicate_params,
+            adapters=self._adapters,
+            max_bind_params=self.max_bind_params,
+            max_inclause_size=self.max_inclause_size,
+            max_query_length=self.max_query_length,
+            fingerprint=self.fingerprint,
+            compact_params=self.compact_params,
+        )
+
+    def prepare_script(self, sources, data, combine=True, separator=";\n"):
+        """Prepares a list of templates that all render with the same data.
+
+        With combine=True, returns a single (query, bind_params) with the
+        statements joined by separator, so that the whole script can be sent
+        in one execute call. Parameters are numbered across the statements,
+        so numeric and asyncpg placeholders keep counting up. A trailing
+        semicolon is removed from each statement, and statements that
+        render to nothing are left out. A statement whose last line
+        contains -- gets a newline before the separator. The driver must accept several
+        statements in one query.
+
+        With combine=False, returns a list of (query, bind_params), one per
+        template, each numbered from the start.
+
+        With fingerprint=True, a QueryFingerprint is added to each result.
+        The observer is called once per template, with the parameters and
+        length of its own statement.
+        """
+        observer = self.observer
+        compiled = []
+        compile_times = []
+        for source in sources:
+            start = perf_counter()
+            compiled.append(self._get_compiled(source))
+            compile_times.append(perf_counter() - start)
+        if not combine:
+            return [self._prepare_query(c, data, compile_time, self.fingerprint)
+                    for c, compile_time in zip(compiled, compile_times)]
+
+        state = self._new_bind_state()
+        if self.fingerprint:
+            state.hasher = _new_hash()
+        statements = []
+        length = 0
+        for c, compile_time in zip(compiled, compile_times):
+            if observer is not None:
+                start = perf_counter()
+                first_param = state.param_index
+                first_in_clause = state.in_clause_count
+            statement = self._render(c, data, state).strip()
+            if statement.endswith(";"):
+                statement = statement[:-1].rstrip()
+            if "--" in statement[statement.rfind("\n") + 1:]:
+                # The last line may end in a comment, which would swallow
+                # the separator, so the separator goes on the next line
+                statement += "\n"
+            if observer is not None:
+                self._notify(c, state, statement, compile_time, perf_counter() - start,
+                             first_param, first_in_clause)
+            if statement:
+                # Checked before joining, so an oversized script is never built
+                if statements:
+                    length += len(separator)
+                length = self._check_length(length + len(statement))
+                statements.append(statement)
+        query = separator.join(statements)
+        if self.fingerprint:
+            return query, state.bind_params, self._fingerprint(query, state)
+        return query, state.bind_params
+
+    def prepare_many(self, source, rows, chunk_size=None):
+        """Prepares a query that is executed once per row, as with cursor.executemany.
+
+        Returns (query, [bind_params_row1, bind_params_row2, ...]). Every row
+        must render to the same query, otherwise InconsistentQueryException
+        is raised. 
+
+        If chunk_size is provided, rows can be any iterable including a generator,
+        and a generator of (query, bind_params_list) pairs with at most 
+        chunk_size rows each is returned instead.
+        """
+        chunks = self._prepare_many(source, rows, chunk_size)
+        if chunk_size:
+            return chunks
+
+        for query, params_list in chunks:
+            return query, params_list
+        raise ValueError("prepare_many needs at least one row")
+
+    def _prepare_many(self, source, rows, chunk_size):
+        compiled = self._get_compiled(source)
+        if compiled.plan is None:
+            # Control flow can change the text, so every row is rendered
+            prepared = (self._prepare_query(compiled, row) for row in rows)
+        else:
+            prepared = self._prepare_plan_rows(compiled, rows)
+        query = None
+        params_list = []
+        for index, (row_query, params) in enumerate(prepared):
+            if query is None:
+                query = row_query
+            elif row_query != query:
+                raise InconsistentQueryException(
+                    "Row %s renders a different query than the first row" % index)
+            params_list.append(params)
+            if len(params_list) == chunk_size:
+                yield query, params_list
+                params_list = []
+
+        if params_list:
+            yield query, params_list
+
+    def _prepare_plan_rows(self, compiled, rows):
+        """Yields (query, bind_params) for each row of a template with a
+        query plan. Only the values change from row to row, so the text is
+        built for the first row alone. For the others, what each variable
+        renders to is compared with the first row, which catches Markup
+        values, and the query is None if it differs"""
+        observer = self.observer
+        plan = compiled.plan
+        query = first_outputs = None
+        for row in rows:
+            if observer is not None:
+                start = perf_counter()
+            state = self._new_bind_state()
+            token = _bind_state.set(state)
+            try:
+                outputs = plan.bind_values(row)
+            finally:
+                _bind_state.reset(token)
+
+            if query is None:
+                query = plan.join(outputs)
+                self._check_length(len(query))
+                first_outputs = outputs
+            if observer is not None:
+                self._notify(compiled, state, query, 0.0, perf_counter() - start)
+            yield (query if outputs == first_outputs else None), state.bind_params
+
+    def _get_compiled(self, source):
+        """Returns the _CompiledQuery for source, which is either
+        a template string or a compiled Template"""
+        if isinstance(source, Template):
+            return self._specialized.get(source) or _CompiledQuery(source)
+
+        cache = self._template_cache
+        if cache is None:
+            return _CompiledQuery(self.env.from_string(source), source=source)
+
+        # The cache belongs to one environment, and placeholders are only
+        # chosen while rendering, so the source alone is the key
+        compiled = cache.get(source)
+        if compiled is None:
+            compiled = self._compile(source)
+            cache.put(source, compiled)
+        return compiled
+
+    def _compile(self, source):
+        ast = self.env.parse(source)
+        template = self.env.from_string(ast)
+        return _CompiledQuery(template, _QueryPlan.build(self.env, template, ast), source)
+
+    def analyze(self, source):
+        """Returns a jinjasql.analysis.TemplateAnalysis listing the bind
+        parameters, filter usages and data paths of a template string or a
+        template loaded from env.loader, without rendering it. The result
+        is computed once per template"""
+        from jinjasql.analysis import analyze_ast
         if isinstance(source, Template):
-            template = source
+            analysis = self._analyses.get(source)
+            if analysis is None:
+                ast = self.env.parse(self._template_source(source))
+                analysis = self._analyses[source] = analyze_ast(ast)
+            return analysis
+
+        compiled = self._get_compiled(source)
+        if compiled.analysis is None:
+            compiled.analysis = analyze_ast(self.env.parse(source))
+        return compiled.analysis
+
+    def specialize(self, source, constants):
+        """Returns a template equivalent to source for data that includes
+        constants, with everything that only depends on constants evaluated
+        in advance: {% if %} blocks are replaced by the branch they take,
+        and outputs that don't bind a parameter, such as identifiers, by
+        their text. Pass the returned template to prepare_query along with
+        the rest of the data, which must not override any of the constants.
+
+        source is a template string or a template loaded from env.loader.
+        Specializing is much slower than rendering, so do it once and keep
+        the result.
+        """
+        from jinjasql.specialize import specialize_ast
+        if isinstance(source, Template):
+            source = self._template_source(source)
+        ast = specialize_ast(self, self.env.parse(source), constants)
+        template = self.env.from_string(ast, globals=constants)
+        self._specialized[template] = _CompiledQuery(
+            template, _QueryPlan.build(self.env, template, ast))
+        return template
+
+    def _template_source(self, template):
+        if template.name is None or self.env.loader is None:
+            raise ValueError("Only templates loaded from env.loader can be used here, "
+                             "pass the template source instead")
+        return self.env.loader.get_source(self.env, template.name)[0]
+
+    def cache_info(self):
+        """Returns hits, misses, evictions and size of the compiled template cache"""
+        if self._template_cache is None:
+            return CacheInfo(0, 0, 0, 0, 0)
+        return self._template_cache.info()
+
+    def clear_cache(self):
+        """Discards all compiled templates. Call this after changing
+        the environment, for example after adding globals or filters"""
+        if self._template_cache is not None:
+            self._template_cache.clear()
+
+    def watch_templates(self, interval=1.0):
+        """Starts a thread that checks the templates loaded from env.loader
+        for changes every interval seconds, and turns off env.auto_reload.
+        Returns the jinjasql.reload.TemplateWatcher, call stop() on it to
+        restore auto_reload"""
+        from jinjasql.reload import TemplateWatcher
+        if self._watcher is None:
+            self._auto_reload = self.env.auto_reload
+            self.env.auto_reload = False
+            self._watcher = TemplateWatcher(self, interval).start()
+        return self._watcher
+
+    def _stop_watching(self, watcher):
+        if self._watcher is watcher:
+            self._watcher = None
+            self.env.auto_reload = self._auto_reload
+
+    def invalidate_template(self, name):
+        """Drops the loaded template name from the environment's cache, so
+        that it is loaded again the next time it is used. While templates are
+        watched, the templates that include, import or extend it are dropped
+        as well. Returns the names that were invalidated"""
+        watcher = self._watcher
+        names = watcher.affected(name) if watcher is not None else [name]
+        cache = self.env.cache
+        if cache is not None and self.env.loader is not None:
+            loader = weakref.ref(self.env.loader)
+            for name in names:
+                try:
+                    del cache[(loader, name)]
+                except KeyError:
+                    pass
+        return names
+
+    def _loaded_templates(self):
+        """Returns (name, template) for every template from env.loader in the
+        environment's cache"""
+        cache = self.env.cache
+        if cache is None or self.env.loader is None:
+            return []
+        loader = self.env.loader
+        # jinja's LRUCache doesn't lock while listing its items, so take its
+        # write lock, or a concurrent eviction can make items() fail
+        lock = getattr(cache, '_wlock', None)
+        if lock is not None:
+            with lock:
+                items = cache.items()
+        else:
+            items = list(cache.items())
+        return [(key[1], template) for key, template in items
+                if key[0]() is loader]
+
+    def register_adapter(self, python_type, adapter):
+        """Converts values of python_type (or its subclasses) with adapter(value)
+        before they are bound. python_type can also be a string such as
+        "numpy.ndarray", to avoid importing the library. Pass None as the 
+        adapter to remove it"""
+        if adapter is None:
+            self._adapters.pop(python_type, None)
         else:
-            template = self.env.from_string(source)
+            self._adapters[python_type] = adapter
+        self._reset_adapter_cache()
+
+    def _reset_adapter_cache(self):
+        if not self._adapters:
+            self._adapter_cache = None
+            return
+        self._adapter_cache = {}
+        for python_type in _PRELOADED_TYPES:
+            self._resolve_adapter(python_type)
+
+    def _resolve_adapter(self, cls):
+        """Finds the adapter for cls through its MRO, and caches the result"""
+        adapters = self._adapters
+        adapter = None
+        for klass in cls.__mro__:
+            adapter = adapters.get(klass) or adapters.get(klass.__module__ + "." + klass.__qualname__)
+            if adapter is not None:
+                break
+        self._adapter_cache[cls] = adapter
+        return adapter
+
+    def _new_bind_state(self):
+        return _BindState(self._placeholder, self._positional, self.in_clause_bucketing,
+                          self._deduplicate, self._adapter_cache, self._resolve_adapter,
+                          self.max_bind_params, self.max_inclause_size, self.compact_params)
+
+    async def prepare_query_async(self, source, data):
+        """Same as prepare_query, but renders with template.render_async,
+        so the environment must be created with enable_async=True.
+        Needs Python 3.7 or later"""
+        if not _HAS_CONTEXTVARS:
+            raise JinjaSqlException("prepare_query_async needs Python 3.7 or later")
+        observer = self.observer
+        if observer is not None:
+            start = perf_counter()
+        compiled = self._get_compiled(source)
+        if observer is not None:
+            compile_time = perf_counter() - start
+            start = perf_counter()
 
-        return self._prepare_query(template, data)
+        state = self._new_bind_state()
+        if self.fingerprint:
+            state.hasher = _new_hash()
+        token = _bind_state.set(state)
+        try:
+            if compiled.plan is not None:
+                query = compiled.plan.render(data)
+                self._check_length(len(query))
+            elif self.max_query_length is None:
+                query = await compiled.template.render_async(data)
+            else:
+                parts = []
+                length = 0
+                chunks = compiled.template.generate_async(data)
+                try:
+                    async for part in chunks:
+                        length = self._check_length(length + len(part))
+                        parts.append(part)
+                finally:
+                    await chunks.aclose()
+                query = "".join(parts)
+        finally:
+            _bind_state.reset(token)
+
+        if observer is not None:
+            self._notify(compiled, state, query, compile_time, perf_counter() - start)
+        if self.fingerprint:
+            return query, state.bind_params, self._fingerprint(query, state)
+        return query, state.bind_params
+
+    def _prepare_query(self, compiled, data, compile_time=0.0, fingerprint=False):
+        observer = self.observer
+        if observer is not None:
+            start = perf_counter()
+
+        state = self._new_bind_state()
+        if fingerprint:
+            state.hasher = _new_hash()
+        query = self._render(compiled, data, state)
+        if observer is not None:
+            self._notify(compiled, state, query, compile_time, perf_counter() - start)
+        if fingerprint:
+            return query, state.bind_params, self._fingerprint(query, state)
+        return query, state.bind_params
 
-    def _prepare_query(self, template, data):
+    def _fingerprint(self, query, state):
+        # Keyed on a digest rather than the query, so that large queries
+        # are not kept alive by the cache
+        key = _new_hash(query.encode('utf-8')).digest()
+        shape = self._shapes.get(key)
+        if shape is None:
+            shape = _query_shape(query)
+            self._shapes.put(key, shape)
+        return QueryFingerprint(shape, state.hasher.hexdigest())
+
+    def _render(self, compiled, data, state):
+        """Renders compiled with data, binding parameters into state"""
+        token = _bind_state.set(state)
         try:
-            _thread_local.bind_params = OrderedDict()
-            _thread_local.param_style = self.param_style
-            _thread_local.param_index = 0
-            query = template.render(data)
-            bind_params = _thread_local.bind_params
-            if self.param_style in ('named', 'pyformat'):
-                bind_params = dict(bind_params)
-            elif self.param_style in ('qmark', 'numeric', 'format', 'asyncpg'):
-                bind_params = list(bind_params.values())
-            return query, bind_params
+            if compiled.plan is not None:
+                query = compiled.plan.render(data)
+                self._check_length(len(query))
+                return query
+            if self.max_query_length is None:
+                return compiled.template.render(data)
+            # Render chunk by chunk, so that an oversized query
+            # is stopped before all of it is built
+            parts = []
+            length = 0
+            chunks = compiled.template.generate(data)
+            try:
+                for part in chunks:
+                    length = self._check_length(length + len(part))
+                    parts.append(part)
+            finally:
+                chunks.close()
+            return "".join(parts)
         finally:
-            del _thread_local.bind_params
-            del _thread_local.param_style
-            del _thread_local.param_index
+            _bind_state.reset(token)
+
+    def _check_length(self, length):
+        if self.max_query_length is not None and length > self.max_query_length:
+            raise QueryLimitExceededException(
+                "The query is longer than max_query_length=%s" % self.max_query_length)
+        return length
+
+    def prepare_query_stream(self, source, data, buffer_size=8192):
+        """Same as prepare_query, but yields (sql_chunk, bind_params) pairs
+        while the template renders, so the whole query is never held in memory.
+
+        bind_params has only the parameters bound by that chunk. Placeholder
+        numbers continue across chunks, so concatenating the chunks and the 
+        parameters gives the same result as prepare_query. Chunks are at least
+        buffer_size characters long, except for the last one.
+        """
+        compiled = self._get_compiled(source)
+        state = self._new_bind_state()
+        chunks = compiled.template.generate(data)
+        buffered = []
+        buffered_size = 0
+        length = 0
+        while True:
+            # Only bind while jinja is producing a chunk. The caller may
+            # prepare other queries between chunks
+            token = _bind_state.set(state)
+            try:
+                chunk = next(chunks, None)
+            finally:
+                _bind_state.reset(token)
+
+            if chunk is not None:
+                length = self._check_length(length + len(chunk))
+                buffered.append(chunk)
+                buffered_size += len(chunk)
+                if buffered_size < buffer_size:
+                    continue
+            if buffered_size or state.bind_params:
+                params = state.bind_params
+                state.bind_params = state.new_params(state.param_index + 1)
+                yield "".join(buffered), params
+                buffered = []
+                buffered_size = 0
+            if chunk is None:
+                return
+
+    def prepare_split_query(self, header, row, rows, footer="", separator=",",
+                            data=None, max_params=None, max_bytes=None):
+        """Builds a statement from a header, one row template per row, and a footer,
+        starting a new statement whenever the next row would take it over 
+        max_params bind parameters or max_bytes bytes of UTF-8 query text, or
+        over the max_query_length characters this JinjaSql was created with.
+
+        For example, with header "insert into t (a, b) values ", row 
+        "({{ row.a }}, {{ row.b }})" and max_params=65535, the rows are inserted
+        with as few statements as postgres allows. header and footer render 
+        with data, each row renders with data plus the row as `row`. rows can
+        be a generator, and statements are yielded as (query, bind_params) as
+        soon as they are full, so memory use does not grow with the number of rows.
+        """
+        data = data or {}
+        header, row, footer = [self._get_compiled(s) for s in (header, row, footer)]
+        # No statement binds more parameters than any of the limits, since
+        # every placeholder takes at least one character
+        limits = [limit for limit in (max_params, self.max_bind_params, max_bytes, self.max_query_length)
+                  if limit is not None]
+        footer_params, footer_text = self._measure(footer, data, min(limits) if limits else 0)
+        footer_bytes = _utf8_length(footer_text)
+        max_length = self.max_query_length
+        # Encoding every row is only worth it when there is a byte limit
+        size_of = _utf8_length if max_bytes is not None else len
+        separator_bytes = size_of(separator)
+
+        def exceeds(params, size, length):
+            return ((max_params is not None and params + footer_params > max_params)
+                    or (max_bytes is not None and size + footer_bytes > max_bytes)
+                    or (max_length is not None and length + len(footer_text) > max_length))
+
+        state = None
+        for row_data in rows:
+            context = dict(data, row=row_data)
+            if state is not None:
+                param_index = state.param_index
+                text = self._render(row, context, state)
+                size = statement_bytes + separator_bytes + size_of(text)
+                length = statement_length + len(separator) + len(text)
+                if not exceeds(state.param_index, size, length):
+                    parts.append(separator)
+                    parts.append(text)
+                    statement_bytes = size
+                    statement_length = length
+                    continue
+                # Start a new statement with this row, renumbering its parameters
+                state.truncate(param_index)
+                yield self._finish_split_query(parts, footer, data, state)
+
+            state = self._new_bind_state()
+            parts = [self._render(header, data, state)]
+            text = self._render(row, context, state)
+            parts.append(text)
+            statement_bytes = size_of(parts[0]) + size_of(text)
+            statement_length = len(parts[0]) + len(text)
+            if exceeds(state.param_index, statement_bytes, statement_length):
+                raise QueryLimitExceededException(
+                    "A single row exceeds max_params, max_bytes or max_query_length")
+
+        if state is not None:
+            yield self._finish_split_query(parts, footer, data, state)
+
+    def _measure(self, compiled, data, first_param):
+        """Returns the number of parameters and the text that compiled adds
+        to a statement. Placeholder numbering starts after first_param, the
+        most parameters the statement can have before it, so that the length
+        is not underestimated for numbered param styles"""
+        state = self._new_bind_state()
+        state.max_bind_params = None
+        state.param_index = first_param
+        text = self._render(compiled, data, state)
+        return state.param_index - first_param, text
+
+    def _finish_split_query(self, parts, footer, data, state):
+        parts.append(self._render(footer, data, state))
+        return "".join(parts), state.bind_params
+
+    def _notify(self, compiled, state, query, compile_time, render_time,
+                first_param=0, first_in_clause=0):
+        """Reports a render to the observer. A statement that was rendered
+        into a state shared with others passes the counts it started from"""
+        self.observer.on_render(RenderEvent(
+            template_name=compiled.template.name,
+            template_hash=compiled.template_hash,
+            compile_time=compile_time,
+            render_time=render_time,
+            bind_params=state.param_index - first_param,
+            in_clauses=state.in_clause_count - first_in_clause,
+            query_length=len(query),
+        ))
@@ -0,0 +1,152 @@
+"""Executing JinjaSQL templates with cached prepared statements.
+
+A template usually renders to the same SQL on every call, but drivers
+only see a string, so the database parses and plans it again each time.
+StatementCache (for DB-API 2.0 connections) and AsyncStatementCache (for
+asyncpg connections) keep a least recently used set of prepared
+statements per connection, keyed on the SQL that JinjaSql produced:
+
+    statements = StatementCache(connection, JinjaSql(param_style='qmark'))
+    cursor = statements.execute(template, data)
+    rows = cursor.fetchall()
+
+    statements = AsyncStatementCache(asyncpg_connection)
+    rows = await statements.fetch(template, data)
+
+Create one cache per connection. Neither class is safe to share between
+threads or concurrently running tasks.
+"""
+from hashlib import sha1
+
+from jinjasql.core import JinjaSql, _LRUCache
+
+
+class PreparedStatement(object):
+    """A prepared statement held by a statement cache.
+
+    name is derived from the SQL text only, so it is the same for every
+    render of a template that produces the same SQL, in every process.
+    handle is the driver object - a cursor for DB-API connections, and
+    an asyncpg PreparedStatement for asyncpg connections.
+    """
+    __slots__ = ('name', 'query', 'handle')
+
+    def __init__(self, query, handle):
+        self.name = statement_name(query)
+        self.query = query
+        self.handle = handle
+
+    def __repr__(self):
+        return "<PreparedStatement %s>" % self.name
+
+
+def statement_name(query):
+    """A stable name for the SQL text, usable as a server side statement name"""
+    return "jinjasql_" + sha1(query.encode('utf-8')).hexdigest()[:16]
+
+
+class StatementCache(object):
+    """Executes templates on a DB-API 2.0 connection, with a cursor per
+    distinct query.
+
+    DB-API has no portable prepare call, but drivers that prepare
+    statements per cursor (for example mysql-connector's prepared cursors,
+    or psycopg with prepare=True) only prepare once per cursor and query.
+    Use cursor_factory to create such cursors. The cursor returned by
+    execute is reused for the next execution of the same query, so fetch
+    its results before that.
+    """
+
+    def __init__(self, connection, jinja=None, maxsize=64, cursor_factory=None):
+        self.connection = connection
+        self.jinja = jinja or JinjaSql()
+        self.cursor_factory = cursor_factory or (lambda connection: connection.cursor())
+        self._statements = _LRUCache(maxsize, on_evict=_close_cursor)
+
+    def prepare(self, source, data):
+        """Returns (PreparedStatement, bind_params) for the rendered template"""
+        # [:2] drops the fingerprint of a JinjaSql created with fingerprint=True
+        query, bind_params = self.jinja.prepare_query(source, data)[:2]
+        return self._statement(query), bind_params
+
+    def execute(self, source, data):
+        statement, bind_params = self.prepare(source, data)
+        statement.handle.execute(statement.query, bind_params)
+        return statement.handle
+
+    def executemany(self, source, rows):
+        query, params_list = self.jinja.prepare_many(source, rows)
+        statement = self._statement(query)
+        statement.handle.executemany(statement.query, params_list)
+        return statement.handle
+
+    def _statement(self, query):
+        statement = self._statements.get(query)
+        if statement is None:
+            statement = PreparedStatement(query, self.cursor_factory(self.connection))
+            self._statements.put(query, statement)
+        return statement
+
+    def cache_info(self):
+        return self._statements.info()
+
+    def close(self):
+        """Closes all cached cursors. The connection is left open"""
+        self._statements.clear()
+
+
+def _close_cursor(statement):
+    statement.handle.close()
+
+
+class AsyncStatementCache(object):
+    """Runs templates on an asyncpg connection with cached prepared statements.
+
+    The JinjaSql must use the asyncpg param style. If its environment has
+    enable_async=True, templates are rendered with prepare_query_async.
+    """
+
+    def __init__(self, connection, jinja=None, maxsize=64):
+        self.jinja = jinja or JinjaSql(param_style='asyncpg')
+        if self.jinja.param_style != 'asyncpg':
+            raise ValueError("AsyncStatementCache needs a JinjaSql with param_style='asyncpg'")
+        self.connection = connection
+        self._statements = _LRUCache(maxsize)
+
+    async def prepare(self, source, data):
+        """Returns (PreparedStatement, bind_params) for the rendered template"""
+        if self.jinja.env.is_async:
+            query, bind_params = (await self.jinja.prepare_query_async(source, data))[:2]
+        else:
+            query, bind_params = self.jinja.prepare_query(source, data)[:2]
+        return await self._statement(query), bind_params
+
+    async def fetch(self, source, data, timeout=None):
+        statement, bind_params = await self.prepare(source, data)
+        return await statement.handle.fetch(*bind_params, timeout=timeout)
+
+    async def fetchrow(self, source, data, timeout=None):
+        statement, bind_params = await self.prepare(source, data)
+        return await statement.handle.fetchrow(*bind_params, timeout=timeout)
+
+    async def fetchval(self, source, data, column=0, timeout=None):
+        statement, bind_params = await self.prepare(source, data)
+        return await statement.handle.fetchval(*bind_params, column=column, timeout=timeout)
+
+    async def executemany(self, source, rows, timeout=None):
+        query, params_list = self.jinja.prepare_many(source, rows)
+        statement = await self._statement(query)
+        return await statement.handle.executemany(params_list, timeout=timeout)
+
+    async def _statement(self, query):
+        statement = self._statements.get(query)
+        if statement is None:
+            statement = PreparedStatement(query, await self.connection.prepare(query))
+            self._statements.put(query, statement)
+        return statement
+
+    def cache_info(self):
+        return self._statements.info()
+
+    def clear(self):
+        self._statements.clear()
@@ -0,0 +1,153 @@
+"""Render instrumentation for JinjaSql.
+
+Pass an observer to JinjaSql to find out which templates are slow or
+produce many bind parameters:
+
+    stats = RenderStats()
+    j = JinjaSql(observer=stats)
+    ...
+    print(format_prometheus(stats))
+
+When no observer is set, JinjaSql doesn't time or count anything.
+"""
+import math
+from collections import deque, namedtuple
+from threading import Lock
+
+# template_name is the loader name of the template, or None for templates
+# compiled from a string. template_hash is a short hash of the template
+# source, or None for templates that were not compiled from a string.
+# compile_time is the time taken to get the compiled template, which is
+# close to zero when it comes from the cache. Times are in seconds.
+RenderEvent = namedtuple('RenderEvent', [
+    'template_name', 'template_hash', 'compile_time', 'render_time',
+    'bind_params', 'in_clauses', 'query_length'])
+
+
+class RenderObserver(object):
+    """Base class for observers. JinjaSql calls on_render once
+    for every query it prepares"""
+
+    def on_render(self, event):
+        pass
+
+
+class RenderStats(RenderObserver):
+    """Aggregates render events in memory, per template.
+
+    Keeps counts and totals for all events, and the most recent
+    window events per template for percentiles. Thread safe.
+    """
+    FIELDS = ('compile_time', 'render_time', 'bind_params', 'in_clauses', 'query_length')
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._lock = Lock()
+        self._templates = {}
+
+    def on_render(self, event):
+        key = event.template_name or event.template_hash or '<template>'
+        with self._lock:
+            stats = self._templates.get(key)
+            if stats is None:
+                stats = self._templates[key] = _TemplateStats(self.window)
+            stats.add(event)
+
+    def templates(self):
+        with self._lock:
+            return sorted(self._templates)
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """Returns a dict of template -> {'count': n, field: {'sum': total,
+        'p50': value, ...}} for every field in RenderStats.FIELDS"""
+        with self._lock:
+            return dict((key, stats.summary(percentiles))
+                        for key, stats in self._templates.items())
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+
+
+class _TemplateStats(object):
+    def __init__(self, window):
+        self.count = 0
+        self.sums = dict.fromkeys(RenderStats.FIELDS, 0)
+        self.samples = dict((field, deque(maxlen=window)) for field in RenderStats.FIELDS)
+
+    def add(self, event):
+        self.count += 1
+        for field in RenderStats.FIELDS:
+            value = getattr(event, field)
+            self.sums[field] += value
+            self.samples[field].append(value)
+
+    def summary(self, percentiles):
+        result = {'count': self.count}
+        for field in RenderStats.FIELDS:
+            values = sorted(self.samples[field])
+            field_summary = {'sum': self.sums[field]}
+            for p in percentiles:
+                field_summary['p%s' % p] = _percentile(values, p)
+            result[field] = field_summary
+        return result
+
+
+def _percentile(sorted_values, percentile):
+    """Nearest rank percentile"""
+    if not sorted_values:
+        return 0
+    rank = int(math.ceil(percentile / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+
+_PROMETHEUS_METRICS = (
+    ('render_time', 'jinjasql_render_seconds', 'Time to render a query'),
+    ('compile_time', 'jinjasql_compile_seconds', 'Time to get the compiled template'),
+    ('bind_params', 'jinjasql_bind_params', 'Number of bind parameters per query'),
+    ('in_clauses', 'jinjasql_in_clauses', 'Number of inclause expansions per query'),
+    ('query_length', 'jinjasql_query_length', 'Length of the rendered query'),
+)
+
+
+def format_prometheus(stats, percentiles=(50, 90, 99)):
+    """Formats RenderStats in the Prometheus text exposition format,
+    as one summary per metric labelled by template"""
+    summary = stats.summary(percentiles)
+    lines = []
+    for field, metric, description in _PROMETHEUS_METRICS:
+        lines.append('# HELP %s %s' % (metric, description))
+        lines.append('# TYPE %s summary' % metric)
+        for template in sorted(summary):
+            label = 'template="%s"' % _escape_label(template)
+            field_summary = summary[template][field]
+            for p in percentiles:
+                lines.append('%s{%s,quantile="%s"} %s' % (
+                    metric, label, p / 100.0, field_summary['p%s' % p]))
+            lines.append('%s_sum{%s} %s' % (metric, label, field_summary['sum']))
+            lines.append('%s_count{%s} %s' % (metric, label, summary[template]['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def format_statsd(stats, prefix='jinjasql', percentiles=(50, 90, 99)):
+    """Formats RenderStats as StatsD gauges, one per line. Times are in
+    milliseconds, for example jinjasql.report_sql.render_ms.p99:1.25|g"""
+    summary = stats.summary(percentiles)
+    lines = []
+    for template in sorted(summary):
+        name = '%s.%s' % (prefix, _statsd_name(template))
+        lines.append('%s.count:%s|g' % (name, summary[template]['count']))
+        for field in RenderStats.FIELDS:
+            scale, metric = (1000, field.replace('_time', '_ms')) if field.endswith('_time') else (1, field)
+            for p in percentiles:
+                value = summary[template][field]['p%s' % p] * scale
+                lines.append('%s.%s.p%s:%s|g' % (name, metric, p, value))
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _statsd_name(value):
+    return ''.join(c if c.isalnum() or c in '-_' else '_' for c in value)
@@ -0,0 +1,79 @@
+"""Rendering queries in a pool of processes.
+
+Jinja templates can't be pickled, so a process pool can't simply call
+JinjaSql.prepare_query. RenderProcessPool compiles the templates once in
+the parent process and ships the python code objects to every worker when
+it starts. Jobs then only send an index and the data. Create one with
+JinjaSql.process_pool() and pass it to JinjaSql.prepare_queries().
+"""
+import marshal
+from concurrent.futures import ProcessPoolExecutor
+
+from jinja2 import Environment
+from jinjasql.core import JinjaSql, _CompiledQuery, _QueryPlan
+
+# Set up in each worker process by _init_worker
+_worker_jinja = None
+_worker_templates = None
+
+
+class RenderProcessPool(ProcessPoolExecutor):
+    """A process pool whose workers have a JinjaSql with the same options as
+    the one that created it, and the given template sources precompiled.
+
+    Workers get an Environment with the same loader, so includes and
+    imports work as long as the loader can be pickled. Other environment
+    settings, the observer and the template cache are not shipped.
+    """
+
+    def __init__(self, jinja, sources=(), max_workers=None):
+        self.source_index = {}
+        compiled_sources = []
+        for source in sources:
+            if source not in self.source_index:
+                self.source_index[source] = len(compiled_sources)
+                compiled_sources.append(_compile_for_worker(jinja, source))
+
+        super(RenderProcessPool, self).__init__(
+            max_workers, initializer=_init_worker,
+            initargs=(jinja._worker_options(), jinja.env.loader, compiled_sources))
+
+    def prepare_queries(self, jobs, chunksize=1):
+        keys = []
+        datas = []
+        for source, data in jobs:
+            if not isinstance(source, str):
+                raise TypeError("Only template strings can be rendered in a process pool")
+            keys.append(self.source_index.get(source, source))
+            datas.append(data)
+        return list(self.map(_render_in_worker, keys, datas, chunksize=chunksize))
+
+
+def _compile_for_worker(jinja, source):
+    """Returns the marshalled code of the compiled template and its query plan"""
+    env = jinja.env
+    ast = env.parse(source)
+    code = env.compile(ast)
+    template = env.template_class.from_code(env, code, env.make_globals(None))
+    plan = _QueryPlan.build(env, template, ast)
+    return source, marshal.dumps(code), (plan.steps, plan.tail) if plan is not None else None
+
+
+def _init_worker(options, loader, compiled_sources):
+    global _worker_jinja, _worker_templates
+    _worker_jinja = JinjaSql(Environment(loader=loader), **options)
+    env = _worker_jinja.env
+    _worker_templates = []
+    for source, code, plan in compiled_sources:
+        template = env.template_class.from_code(env, marshal.loads(code), env.make_globals(None))
+        if plan is not None:
+            plan = _QueryPlan(env, template, *plan)
+        _worker_templates.append(_CompiledQuery(template, plan, source))
+
+
+def _render_in_worker(key, data):
+    if isinstance(key, int):
+        compiled = _worker_templates[key]
+    else:
+        compiled = _worker_jinja._get_compiled(key)
+    return _worker_jinja._prepare_query(compiled, data, fingerprint=_worker_jinja.fingerprint)
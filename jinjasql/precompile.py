@@ -0,0 +1,49 @@
+"""Ahead of time compilation of JinjaSQL templates.
+
+Compiling a template means lexing it, applying the SqlExtension rewrite,
+parsing and generating python code. For a large tree of templates, this
+makes the first query for every template slow after each deploy.
+precompile_templates does this work once, at build time, and writes one
+python module per template. A JinjaSql created with
+precompiled_templates=<target> then loads the modules without compiling:
+
+    precompile_templates('sql/', 'build/sql_compiled')
+
+    j = JinjaSql(precompiled_templates='build/sql_compiled')
+    j.prepare_query(j.env.get_template('report.sql'), data)
+
+The same can be done from the command line with
+`jinjasql compile sql/ build/sql_compiled`.
+"""
+import compileall
+
+from jinja2 import Environment, FileSystemLoader
+from jinjasql.core import JinjaSql
+
+
+def precompile_templates(source, target, extensions=None, filter_func=None,
+                         log_function=None):
+    """Compiles every template from source into a python module in the
+    directory target.
+
+    source is a directory of templates, a jinja2 loader, or an Environment
+    with a loader. Pass an Environment if you use custom options such as
+    block delimiters - they must match the environment that later loads
+    the compiled templates. extensions and filter_func restrict the 
+    templates that are compiled, as in Environment.compile_templates.
+    """
+    if isinstance(source, Environment):
+        env = source
+    elif isinstance(source, str):
+        env = Environment(loader=FileSystemLoader(source))
+    else:
+        env = Environment(loader=source)
+
+    jinja = JinjaSql(env)
+    jinja.env.compile_templates(
+        target, extensions=extensions, filter_func=filter_func, zip=None,
+        log_function=log_function, ignore_errors=False)
+
+    # compile_templates writes python source. Byte compile it as well,
+    # so that loading a template is just reading a .pyc file
+    compileall.compile_dir(target, quiet=1)
@@ -0,0 +1,126 @@
+"""Reloading file based templates when they change.
+
+With auto_reload, jinja2 checks whether a template changed every time it
+is looked up, which costs a stat call per template per render. A
+TemplateWatcher turns auto_reload off and instead polls the templates in
+the environment's cache from a single background thread:
+
+    j = JinjaSql(Environment(loader=FileSystemLoader('sql/')))
+    watcher = j.watch_templates(interval=1.0)
+    ...
+    watcher.stop()
+
+When a template changes, it is dropped from the cache along with every
+cached template that includes, imports or extends it, directly or through
+other templates. Everything else stays loaded.
+"""
+import logging
+from collections import defaultdict
+from threading import Event, Lock, Thread
+
+from jinja2 import TemplateError, TemplateNotFound, meta
+
+_log = logging.getLogger(__name__)
+
+
+class TemplateWatcher(object):
+    """Polls the templates loaded by a JinjaSql, and invalidates those that
+    changed. Create one with JinjaSql.watch_templates().
+
+    Dependencies are found with jinja2.meta.find_referenced_templates the
+    first time the watcher sees a template. Includes and imports whose
+    template name is computed at render time are not tracked.
+    """
+
+    def __init__(self, jinja, interval=1.0):
+        self.jinja = jinja
+        self.interval = interval
+        self._lock = Lock()
+        # name -> names of the templates it includes, imports or extends
+        self._references = {}
+        # name -> names of the templates that reference it
+        self._referenced_by = defaultdict(set)
+        self._stopped = Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._run, name="jinjasql-template-watcher")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.jinja._stop_watching(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                # auto_reload stays off while watching, so the thread
+                # must keep going, or templates would never reload again
+                _log.exception("Checking templates for changes failed")
+
+    def check(self):
+        """Invalidates every loaded template whose source changed,
+        and returns their names"""
+        changed = []
+        for name, template in self.jinja._loaded_templates():
+            if not template.is_up_to_date:
+                changed.append(name)
+            elif name not in self._references:
+                self._track(name)
+
+        for name in changed:
+            self.jinja.invalidate_template(name)
+        return changed
+
+    def affected(self, name):
+        """Returns name and the names of all tracked templates that depend
+        on it. They will be loaded again, so their dependencies are
+        forgotten until the watcher sees them next"""
+        with self._lock:
+            affected = set([name])
+            pending = [name]
+            while pending:
+                for dependent in self._referenced_by.get(pending.pop(), ()):
+                    if dependent not in affected:
+                        affected.add(dependent)
+                        pending.append(dependent)
+
+            for dependent in affected:
+                for reference in self._references.pop(dependent, ()):
+                    self._referenced_by[reference].discard(dependent)
+        return sorted(affected)
+
+    def _track(self, name):
+        env = self.jinja.env
+        try:
+            source = env.loader.get_source(env, name)[0]
+        except (TemplateNotFound, RuntimeError):
+            # Deleted since it was loaded, or a loader without access
+            # to the source, such as the one for precompiled templates
+            references = set()
+        else:
+            try:
+                ast = env.parse(source)
+            except TemplateError:
+                # Changed since it was loaded. The next check invalidates
+                # it, and it is tracked again once it loads
+                return
+            references = set(reference for reference in meta.find_referenced_templates(ast)
+                             if reference is not None)
+
+        with self._lock:
+            self._references[name] = references
+            for reference in references:
+                self._referenced_by[reference].add(name)
@@ -0,0 +1,142 @@
+"""Partial evaluation of templates against constant data, see JinjaSql.specialize"""
+from itertools import chain
+
+from jinja2 import nodes
+
+from jinjasql.core import _bind_state, _SPECIAL_NAMES
+
+# Expressions containing these are never evaluated ahead of time,
+# because their result can change between renders
+_IMPURE_FILTERS = frozenset(('random',))
+
+
+class _Specializer(object):
+    """Rewrites a parsed template, replacing {% if %} blocks whose tests
+    only use constants with the branch that is taken, and outputs that
+    only use constants and don't bind a parameter with their text"""
+
+    def __init__(self, jinja, constants, ast):
+        self.jinja = jinja
+        self.constants = constants
+        # Names that the template assigns anywhere are never treated as
+        # constants, even where the assignment is not in scope
+        local_names = set(node.name for node in ast.find_all(nodes.Name)
+                          if node.ctx in ('store', 'param'))
+        local_names.update(node.name for node in ast.find_all(nodes.Macro))
+        local_names.update(node.target for node in ast.find_all(nodes.Import))
+        for node in ast.find_all(nodes.FromImport):
+            local_names.update(name if isinstance(name, str) else name[1] for name in node.names)
+        self.constant_names = set(constants) - local_names - _SPECIAL_NAMES
+
+    def fold(self, node):
+        if isinstance(node, nodes.If):
+            return self._fold_if(node)
+        for field in node.fields:
+            value = getattr(node, field)
+            if isinstance(value, list) and value and all(isinstance(v, nodes.Stmt) for v in value):
+                setattr(node, field, self._fold_statements(value))
+        return node
+
+    def _fold_statements(self, statements):
+        result = []
+        for statement in statements:
+            if isinstance(statement, nodes.If) and self._is_constant(statement.test):
+                branch = self._taken_branch(statement)
+                if branch is None:
+                    result.append(self.fold(statement))
+                else:
+                    result.extend(self._fold_statements(branch))
+            elif isinstance(statement, nodes.Output):
+                statement.nodes = [self._fold_expression(node) for node in statement.nodes]
+                result.append(statement)
+            else:
+                result.append(self.fold(statement))
+        return result
+
+    def _fold_if(self, statement):
+        """Folds the branches of an if block whose own test is not constant.
+        A constant elif that is false is removed. One that is true is always
+        taken when it is reached, so it becomes the else branch, and the
+        elifs after it are dropped"""
+        statement.body = self._fold_statements(statement.body)
+        elifs = []
+        else_ = statement.else_
+        for branch in statement.elif_:
+            if self._is_constant(branch.test):
+                taken = self._test_result(branch.test)
+                if taken is False:
+                    continue
+                if taken is True:
+                    else_ = branch.body
+                    break
+            branch.body = self._fold_statements(branch.body)
+            elifs.append(branch)
+        statement.elif_ = elifs
+        statement.else_ = self._fold_statements(else_)
+        return statement
+
+    def _test_result(self, test):
+        """Returns whether test is true with the constants, or None
+        if it can't be evaluated"""
+        text = self._evaluate(nodes.If(test, [nodes.Output([nodes.TemplateData('1')])], [], []))
+        if text is None:
+            return None
+        return bool(text)
+
+    def _taken_branch(self, statement):
+        """Returns the statements of the branch that the if block takes,
+        or None if the test can't be evaluated"""
+        test = self._test_result(statement.test)
+        if test is None:
+            return None
+        if test:
+            return statement.body
+        if not statement.elif_:
+            return statement.else_
+        # Continue with the elifs, as if they were nested if blocks
+        first = statement.elif_[0]
+        rest = nodes.If(first.test, first.body, statement.elif_[1:], statement.else_,
+                        lineno=first.lineno)
+        return self._fold_statements([rest])
+
+    def _fold_expression(self, node):
+        if isinstance(node, nodes.TemplateData) or not self._is_constant(node):
+            return node
+        text = self._evaluate(nodes.Output([node]))
+        if text is None:
+            return node
+        return nodes.TemplateData(text, lineno=node.lineno)
+
+    def _is_constant(self, node):
+        for child in chain([node], node.find_all(nodes.Expr)):
+            if isinstance(child, nodes.Call):
+                return False
+            if isinstance(child, nodes.Filter) and child.name in _IMPURE_FILTERS:
+                return False
+            if isinstance(child, nodes.Name) and child.name not in self.constant_names:
+                return False
+        return True
+
+    def _evaluate(self, statement):
+        """Renders statement with the constants. Returns None if that binds
+        a parameter or fails, so the statement has to stay in the template"""
+        env = self.jinja.env
+        ast = nodes.Template([statement], lineno=1)
+        ast.set_lineno(1)
+        ast.set_environment(env)
+        state = self.jinja._new_bind_state()
+        token = _bind_state.set(state)
+        try:
+            text = env.from_string(ast, globals=self.constants).render()
+        except Exception:
+            return None
+        finally:
+            _bind_state.reset(token)
+        if state.param_index:
+            return None
+        return text
+
+
+def specialize_ast(jinja, ast, constants):
+    """Folds the parts of ast that only depend on constants, in place"""
+    return _Specializer(jinja, constants, ast).fold(ast)
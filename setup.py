@@ -41,6 +41,9 @@ sdict = {
     'install_requires': [
         'Jinja2>=2.5,<3.0'
     ],
+    'entry_points': {
+        'console_scripts': ['jinjasql = jinjasql.cli:main'],
+    },
     'classifiers' : [
         'Development Status :: 4 - Beta',
         'Environment :: Console',
@@ -1,11 +1,21 @@
 import sys
 import unittest
 from tests.test_jinjasql import JinjaSqlTest
+from tests.test_instrumentation import InstrumentationTest
+from tests.test_precompile import PrecompileTest
+from tests.test_concurrency import ConcurrencyTest
+from tests.test_execution import StatementCacheTest
+from tests.test_reload import ReloadTest
 from tests.test_real_database import PostgresTest, MySqlTest
 
 def all_tests():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(JinjaSqlTest))
+    suite.addTest(unittest.makeSuite(InstrumentationTest))
+    suite.addTest(unittest.makeSuite(PrecompileTest))
+    suite.addTest(unittest.makeSuite(ConcurrencyTest))
+    suite.addTest(unittest.makeSuite(StatementCacheTest))
+    suite.addTest(unittest.makeSuite(ReloadTest))
     suite.addTest(unittest.makeSuite(PostgresTest))
     suite.addTest(unittest.makeSuite(MySqlTest))
 
@@ -0,0 +1,80 @@
+import sys
+import threading
+import unittest
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from jinja2 import DictLoader
+from jinja2 import Environment
+from jinjasql import JinjaSql
+
+_SIMPLE = "select * from t where id = {{ id }} and name = {{ name }}"
+_REPORT = ("{% import 'utils.sql' as utils %}select * from t where id in {{ ids | inclause }}"
+           "{% if name %} and {{ utils.eq('name', name) }}{% endif %}")
+_LOADER = DictLoader({"utils.sql": "{% macro eq(column, value) %}{{ column | sqlsafe }} = {{ value }}{% endmacro %}"})
+
+
+def _jobs(count):
+    jobs = []
+    expected = []
+    for i in range(count):
+        ids = list(range(i % 7 + 1))
+        jobs.append((_SIMPLE, {"id": i, "name": "n%s" % i}))
+        expected.append(("select * from t where id = $1 and name = $2", [i, "n%s" % i]))
+        jobs.append((_REPORT, {"ids": ids, "name": "n%s" % i if i % 2 else None}))
+        placeholders = ",".join("$%s" % (n + 1) for n in range(len(ids)))
+        query = "select * from t where id in (%s)" % placeholders
+        params = list(ids)
+        if i % 2:
+            query += " and name = $%s" % (len(ids) + 1)
+            params.append("n%s" % i)
+        expected.append((query, params))
+    return jobs, expected
+
+
+class ConcurrencyTest(unittest.TestCase):
+    def setUp(self):
+        self.j = JinjaSql(Environment(loader=_LOADER), param_style='asyncpg', cache_size=4)
+
+    def test_shared_between_threads(self):
+        jobs, expected = _jobs(200)
+        errors = []
+
+        def worker(offset):
+            try:
+                for index in range(offset, len(jobs), 8):
+                    source, data = jobs[index]
+                    self.assertEqual(self.j.prepare_query(source, data), expected[index])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(offset,)) for offset in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_prepare_queries(self):
+        jobs, expected = _jobs(20)
+        self.assertEqual(self.j.prepare_queries(jobs), expected)
+
+    def test_prepare_queries_thread_pool(self):
+        jobs, expected = _jobs(50)
+        with ThreadPoolExecutor(4) as executor:
+            self.assertEqual(self.j.prepare_queries(jobs, executor), expected)
+
+    @unittest.skipIf(sys.version_info < (3, 7), "process pools need Python 3.7")
+    def test_prepare_queries_process_pool(self):
+        jobs, expected = _jobs(20)
+        # A template that is not shipped up front is compiled by the worker
+        jobs.append(("select {{ x }}", {"x": 1}))
+        expected.append(("select $1", [1]))
+        with self.j.process_pool([_SIMPLE, _REPORT], max_workers=2) as pool:
+            self.assertEqual(self.j.prepare_queries(jobs, pool), expected)
+
+        with ProcessPoolExecutor(1) as pool:
+            with self.assertRaises(ValueError):
+                self.j.prepare_queries(jobs, pool)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import asyncio
+import sqlite3
+import unittest
+from jinjasql import JinjaSql
+from jinjasql.execution import AsyncStatementCache, StatementCache, statement_name
+
+
+class FakeAsyncpgStatement(object):
+    def __init__(self, query):
+        self.query = query
+
+    async def fetch(self, *args, timeout=None):
+        return [(self.query, args)]
+
+    async def fetchval(self, *args, column=0, timeout=None):
+        return args[column]
+
+    async def executemany(self, args, timeout=None):
+        self.executed = args
+
+
+class FakeAsyncpgConnection(object):
+    """Stands in for an asyncpg connection, counting prepare round trips"""
+    def __init__(self):
+        self.prepared = []
+
+    async def prepare(self, query):
+        self.prepared.append(query)
+        return FakeAsyncpgStatement(query)
+
+
+class StatementCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.connection = sqlite3.connect(":memory:")
+        self.connection.execute("create table users (id integer, name text)")
+        self.connection.executemany("insert into users values (?, ?)",
+                                    [(i, "user%s" % i) for i in range(10)])
+        self.addCleanup(self.connection.close)
+
+    def test_execute(self):
+        statements = StatementCache(self.connection, JinjaSql(param_style='qmark'), maxsize=2)
+        source = "select name from users where id {% if ids %}in {{ ids | inclause }}{% else %}= {{ id }}{% endif %}"
+
+        self.assertEqual(statements.execute(source, {"id": 1}).fetchall(), [("user1",)])
+        first, _ = statements.prepare(source, {"id": 2})
+        self.assertEqual(statements.execute(source, {"id": 2}).fetchall(), [("user2",)])
+        second, _ = statements.prepare(source, {"id": 3})
+        self.assertIs(first, second)
+        self.assertEqual(first.name, statement_name("select name from users where id = ?"))
+
+        self.assertEqual(statements.execute(source, {"ids": [3, 4]}).fetchall(), [("user3",), ("user4",)])
+        statements.execute(source, {"ids": [3, 4, 5]})
+        info = statements.cache_info()
+        self.assertEqual((info.currsize, info.evictions), (2, 1))
+        # The first statement's cursor was closed when it was evicted
+        with self.assertRaises(sqlite3.ProgrammingError):
+            first.handle.fetchall()
+
+        statements.close()
+        self.assertEqual(statements.cache_info().currsize, 0)
+
+    def test_executemany(self):
+        statements = StatementCache(self.connection, JinjaSql(param_style='named'))
+        statements.executemany("insert into users values ({{ id }}, {{ name }})",
+                               [{"id": 20, "name": "a"}, {"id": 21, "name": "b"}])
+        rows = statements.execute("select name from users where id >= {{ id }}", {"id": 20}).fetchall()
+        self.assertEqual(rows, [("a",), ("b",)])
+
+    def test_async_statement_cache(self):
+        connection = FakeAsyncpgConnection()
+        statements = AsyncStatementCache(connection)
+        source = "select * from users where id = {{ id }}"
+
+        async def run():
+            first = await statements.fetch(source, {"id": 1})
+            second = await statements.fetch(source, {"id": 2})
+            value = await statements.fetchval(source, {"id": 3})
+            await statements.executemany("insert into users values ({{ id }})", [{"id": 1}, {"id": 2}])
+            return first, second, value
+
+        loop = asyncio.new_event_loop()
+        try:
+            first, second, value = loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+        self.assertEqual(first, [("select * from users where id = $1", (1,))])
+        self.assertEqual(second, [("select * from users where id = $1", (2,))])
+        self.assertEqual(value, 3)
+        self.assertEqual(connection.prepared, [
+            "select * from users where id = $1",
+            "insert into users values ($1)",
+        ])
+
+        with self.assertRaises(ValueError):
+            AsyncStatementCache(connection, JinjaSql(param_style='format'))
+
+
+if __name__ == '__main__':
+    unittest.main()
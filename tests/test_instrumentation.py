@@ -0,0 +1,83 @@
+import unittest
+from jinja2 import DictLoader
+from jinja2 import Environment
+from jinjasql import JinjaSql
+from jinjasql.instrumentation import RenderObserver, RenderStats, format_prometheus, format_statsd
+
+
+class RecordingObserver(RenderObserver):
+    def __init__(self):
+        self.events = []
+
+    def on_render(self, event):
+        self.events.append(event)
+
+
+class InstrumentationTest(unittest.TestCase):
+    def test_render_event(self):
+        observer = RecordingObserver()
+        j = JinjaSql(observer=observer)
+        source = "select * from t where id = {{ id }} and day in {{ days | inclause }}"
+        query, _ = j.prepare_query(source, {"id": 1, "days": ["mon", "tue"]})
+        j.prepare_query(source, {"id": 1, "days": ["mon"]})
+
+        first, second = observer.events
+        self.assertIsNone(first.template_name)
+        self.assertEqual(len(first.template_hash), 16)
+        self.assertEqual(first.template_hash, second.template_hash)
+        self.assertEqual((first.bind_params, first.in_clauses, first.query_length), (3, 1, len(query)))
+        self.assertEqual(second.bind_params, 2)
+        self.assertTrue(first.render_time >= 0 and first.compile_time >= 0)
+
+    def test_prepare_script_events(self):
+        observer = RecordingObserver()
+        j = JinjaSql(observer=observer)
+        sources = ["select {{ a }} where x in {{ ids | inclause }};", "select {{ b }}"]
+        j.prepare_script(sources, {"a": 1, "b": 2, "ids": [3, 4]})
+
+        # One event per statement, counting only its own parameters
+        first, second = observer.events
+        self.assertEqual((first.bind_params, first.in_clauses, first.query_length),
+                         (3, 1, len("select %s where x in (%s,%s)")))
+        self.assertEqual((second.bind_params, second.in_clauses, second.query_length),
+                         (1, 0, len("select %s")))
+
+        j.prepare_script(sources, {"a": 1, "b": 2, "ids": [3]}, combine=False)
+        self.assertEqual([event.bind_params for event in observer.events[2:]], [2, 1])
+
+    def test_loader_template_name(self):
+        observer = RecordingObserver()
+        env = Environment(loader=DictLoader({"report.sql": "select {{ id }}"}))
+        j = JinjaSql(env, observer=observer)
+        j.prepare_query(env.get_template("report.sql"), {"id": 1})
+        self.assertEqual(observer.events[0].template_name, "report.sql")
+        self.assertIsNone(observer.events[0].template_hash)
+
+    def test_render_stats(self):
+        stats = RenderStats()
+        env = Environment(loader=DictLoader({"report.sql": "select {{ ids | inclause }}"}))
+        j = JinjaSql(env, observer=stats)
+        template = env.get_template("report.sql")
+        for size in range(1, 11):
+            j.prepare_query(template, {"ids": list(range(size))})
+
+        self.assertEqual(stats.templates(), ["report.sql"])
+        summary = stats.summary()["report.sql"]
+        self.assertEqual(summary["count"], 10)
+        self.assertEqual(summary["bind_params"]["sum"], 55)
+        self.assertEqual(summary["bind_params"]["p50"], 5)
+        self.assertEqual(summary["bind_params"]["p99"], 10)
+
+        prometheus = format_prometheus(stats)
+        self.assertIn('# TYPE jinjasql_bind_params summary', prometheus)
+        self.assertIn('jinjasql_bind_params{template="report.sql",quantile="0.9"} 9', prometheus)
+        self.assertIn('jinjasql_bind_params_count{template="report.sql"} 10', prometheus)
+
+        statsd = format_statsd(stats)
+        self.assertIn('jinjasql.report_sql.count:10|g', statsd)
+        self.assertIn('jinjasql.report_sql.bind_params.p50:5|g', statsd)
+        self.assertIn('jinjasql.report_sql.render_ms.p99:', statsd)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,23 @@
 from __future__ import unicode_literals
+import asyncio
+import sys
 import unittest
 from jinja2 import DictLoader
 from jinja2 import Environment
 from jinjasql import JinjaSql
-from jinjasql.core import InvalidBindParameterException
+from jinjasql.core import JinjaSqlException, InvalidBindParameterException, InconsistentQueryException
+from jinjasql.core import QueryLimitExceededException, QueryFingerprint, NamedParams
+from markupsafe import Markup
 from datetime import date
+from decimal import Decimal
 from yaml import safe_load_all
 from os.path import dirname, abspath, join
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 YAML_TESTS_ROOT = join(dirname(abspath(__file__)), "yaml")
 
@@ -89,6 +99,22 @@ class JinjaSqlTest(unittest.TestCase):
         self.assertEqual(len(bind_params), num_of_params)
         self.assertEqual(query, "SELECT 'x' WHERE 'A' in (" + "%s," * (num_of_params - 1) + "%s)")
 
+    def test_large_inclause_indexed_styles(self):
+        num_of_params = 10000
+        source = "SELECT 'x' WHERE 'A' in {{alphabets | inclause}}"
+        for param_style, fmt in (('numeric', ':%s'), ('asyncpg', '$%s')):
+            j = JinjaSql(param_style=param_style)
+            query, bind_params = j.prepare_query(source, {"alphabets": ['A'] * num_of_params})
+            placeholders = ",".join(fmt % i for i in range(1, num_of_params + 1))
+            self.assertEqual(query, "SELECT 'x' WHERE 'A' in (" + placeholders + ")")
+            self.assertEqual(bind_params, ['A'] * num_of_params)
+            # Placeholders past the cached table are not kept
+            self.assertEqual(len(j._placeholder.table), j._placeholder.MAX_CACHED)
+
+    def test_invalid_param_style(self):
+        with self.assertRaises(ValueError):
+            JinjaSql(param_style='percent')
+
     def test_identifier_filter(self):
         j = JinjaSql()
         template = 'select * from {{table_name | identifier}}'
@@ -117,6 +143,633 @@ class JinjaSqlTest(unittest.TestCase):
             query, _ = j.prepare_query(template, {'table_name': test[0]})
             self.assertEqual(query, test[1])
 
+    def test_filter_stream_line_numbers(self):
+        source = "select\n{{ a.b }},\n{{ c | sqlsafe }},\n{{ (d ~ e) }}"
+        tokens = list(self.j.env._tokenize(source, None))
+        self.assertEqual(
+            " ".join(str(token.value) for token in tokens if token.type not in ("data", "variable_begin", "variable_end")),
+            "( a . b ) | bind ( a.b ) c | sqlsafe ( ( d ~ e ) ) | bind ( bind#0 )")
+        bind_lines = [token.lineno for token in tokens if token.type == "name" and token.value == "bind"]
+        self.assertEqual(bind_lines, [2, 4])
+
+    def test_template_cache(self):
+        j = JinjaSql()
+        source = "select * from dummy where project_id = {{ request.project_id }}"
+        for i in range(3):
+            query, bind_params = j.prepare_query(source, _DATA)
+            self.assertEqual(query, "select * from dummy where project_id = %s")
+            self.assertEqual(bind_params, [123])
+
+        info = j.cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (2, 1, 1))
+
+        j.clear_cache()
+        self.assertEqual(j.cache_info().currsize, 0)
+
+    def test_template_cache_eviction(self):
+        j = JinjaSql(cache_size=2)
+        j.prepare_query("select {{a}}", {"a": 1})
+        j.prepare_query("select {{b}}", {"b": 2})
+        j.prepare_query("select {{a}}", {"a": 1})
+        j.prepare_query("select {{c}}", {"c": 3})
+
+        info = j.cache_info()
+        self.assertEqual((info.evictions, info.currsize), (1, 2))
+        # {{b}} was the least recently used entry, so it has to be compiled again
+        j.prepare_query("select {{b}}", {"b": 2})
+        self.assertEqual(j.cache_info().misses, 4)
+
+    def test_template_cache_disabled(self):
+        j = JinjaSql(cache_size=0)
+        query, bind_params = j.prepare_query("select {{a}}", {"a": 1})
+        self.assertEqual(query, "select %s")
+        self.assertEqual(j.cache_info(), (0, 0, 0, 0, 0))
+
+    def test_query_plan(self):
+        j = JinjaSql()
+        simple = "select * from t where id = {{ request.project.id }} and user = {{session.user_id}}"
+        self.assertIsNotNone(j._get_compiled(simple).plan)
+
+        not_simple = [
+            "select {% if request.day %}{{ request.day }}{% endif %}",
+            "select {% for d in request.days %}{{ d }}{% endfor %}",
+            "{% macro m(v) %}{{ v }}{% endmacro %}select {{ m(1) }}",
+            "select {{ request.days | inclause }}",
+            "select {{ etc.columns | sqlsafe }}",
+            "select {{ request.days[0] }}",
+            "select {{ '%' ~ request.day ~ '%' }}",
+        ]
+        for source in not_simple:
+            self.assertIsNone(j._get_compiled(source).plan, source)
+
+    def test_query_plan_matches_render(self):
+        sources = [
+            "select * from t where id = {{ request.project.id }} and user = {{session.user_id}}\n",
+            "select {{ request.project_id }}, {{ request.project_id }}, {{ missing }}",
+            "select {{ etc.columns }} from {{ range }}",
+            "select {{ markup }} from {{ request.day }}",
+        ]
+        data = dict(_DATA, markup=Markup("<already safe>"))
+        for source in sources:
+            for param_style in JinjaSql.VALID_PARAM_STYLES:
+                planned = JinjaSql(param_style=param_style)
+                self.assertIsNotNone(planned._get_compiled(source).plan)
+                rendered = JinjaSql(param_style=param_style, cache_size=0)
+                self.assertEqual(planned.prepare_query(source, data),
+                                 rendered.prepare_query(source, data))
+
+    def test_compact_params(self):
+        source = "select * from t where project_id = {{ request.project_id }} and day in {{ request.days | inclause }}"
+        for param_style in ("named", "pyformat"):
+            expected = JinjaSql(param_style=param_style).prepare_query(source, _DATA)
+            query, bind_params = JinjaSql(param_style=param_style, compact_params=True).prepare_query(source, _DATA)
+            self.assertEqual(query, expected[0])
+            self.assertIsInstance(bind_params, NamedParams)
+            self.assertEqual(bind_params, expected[1])
+            self.assertEqual(list(bind_params), list(expected[1]))
+            self.assertEqual(bind_params["request.project_id_1"], 123)
+            for missing in ("request.project_id_2", "request.project_id_01", "request.project_id_\u0661",
+                            "inclause_1", "inclause_x", "inclause_9", "inclause", 1, None, ("inclause", 2)):
+                self.assertNotIn(missing, bind_params)
+                self.assertIsNone(bind_params.get(missing))
+
+        # sqlite3 only accepts a dict for named parameters
+        import sqlite3
+        connection = sqlite3.connect(":memory:")
+        self.addCleanup(connection.close)
+        query, bind_params = JinjaSql(param_style="named", compact_params=True).prepare_query(
+            "select {{ a }}, {{ b }}", {"a": 1, "b": "x"})
+        with self.assertRaises(KeyError):
+            connection.execute(query, bind_params)
+        self.assertEqual(connection.execute(query, dict(bind_params)).fetchall(), [(1, "x")])
+
+        # Positional styles are always a list
+        self.assertIsInstance(JinjaSql(compact_params=True).prepare_query(source, _DATA)[1], list)
+
+        j = JinjaSql(param_style="named", compact_params=True)
+        chunks = list(j.prepare_query_stream("{% for v in values %}{{ v }} {% endfor %}",
+                                             {"values": range(5)}, buffer_size=8))
+        self.assertEqual(dict(chunks[1][1]), {"v_3": 2, "v_4": 3})
+
+        statements = list(j.prepare_split_query("values ", "({{ row }})", [1, 2, 3], max_params=2))
+        self.assertEqual([(query, dict(params)) for query, params in statements], [
+            ("values (:row_1),(:row_2)", {"row_1": 1, "row_2": 2}),
+            ("values (:row_1)", {"row_1": 3}),
+        ])
+
+    def test_prepare_script(self):
+        sources = [
+            "create temp table ids as select id from t where day in {{ days | inclause }};",
+            "{% if extra %}insert into ids values ({{ extra }}){% endif %}",
+            "select * from ids where id > {{ min_id }};  ",
+        ]
+        data = {"days": ["mon", "tue"], "extra": None, "min_id": 5}
+        j = JinjaSql(param_style="asyncpg")
+        self.assertEqual(j.prepare_script(sources, data), (
+            "create temp table ids as select id from t where day in ($1,$2);\n"
+            "select * from ids where id > $3", ["mon", "tue", 5]))
+
+        j = JinjaSql(param_style="named")
+        query, bind_params = j.prepare_script(sources, dict(data, extra=7), separator="; ")
+        self.assertEqual(query, "create temp table ids as select id from t where day in "
+                                "(:inclause_1,:inclause_2); insert into ids values (:extra_3); "
+                                "select * from ids where id > :min_id_4")
+        self.assertEqual(bind_params, {"inclause_1": "mon", "inclause_2": "tue", "extra_3": 7, "min_id_4": 5})
+
+        self.assertEqual(JinjaSql(param_style="numeric").prepare_script(sources, data, combine=False), [
+            ("create temp table ids as select id from t where day in (:1,:2);", ["mon", "tue"]),
+            ("", []),
+            ("select * from ids where id > :1;  ", [5]),
+        ])
+
+        # A trailing line comment doesn't swallow the separator
+        self.assertEqual(JinjaSql().prepare_script(["select {{ a }} -- note", "select {{ b }}"], {"a": 1, "b": 2}),
+                         ("select %s -- note\n;\nselect %s", [1, 2]))
+
+        # The limit applies to the whole script
+        j = JinjaSql(max_query_length=25)
+        self.assertEqual(j.prepare_script(["select {{ a }}", "select {{ b }}"], {"a": 1, "b": 2}),
+                         ("select %s;\nselect %s", [1, 2]))
+        with self.assertRaises(QueryLimitExceededException):
+            j.prepare_script(["select {{ a }}", "select {{ b }}", "select 1"], {"a": 1, "b": 2})
+
+        # A script has the fingerprint of the equivalent single query
+        j = JinjaSql(param_style="asyncpg", fingerprint=True)
+        query, bind_params, fingerprint = j.prepare_script(sources, data)
+        self.assertEqual(fingerprint, j.prepare_query(
+            "create temp table ids as select id from t where day in {{ days | inclause }};\n"
+            "select * from ids where id > {{ min_id }}", data)[2])
+        self.assertEqual([len(result) for result in j.prepare_script(sources, data, combine=False)], [3, 3, 3])
+
+    def test_prepare_many(self):
+        j = JinjaSql(param_style='named')
+        source = "insert into t (id, name) values ({{ id }}, {{ name }})"
+        rows = [{"id": 1, "name": "a"}, {"id": 2, "name": "b"}]
+        query, params_list = j.prepare_many(source, rows)
+        self.assertEqual(query, "insert into t (id, name) values (:id_1, :name_2)")
+        self.assertEqual(params_list, [{"id_1": 1, "name_2": "a"}, {"id_1": 2, "name_2": "b"}])
+
+        with self.assertRaises(ValueError):
+            j.prepare_many(source, [])
+
+        # Templates without control flow bind each row without rendering it,
+        # but a row that changes the text is still caught
+        with self.assertRaises(InconsistentQueryException):
+            j.prepare_many(source, [{"id": 1, "name": "a"}, {"id": Markup("2"), "name": "b"}])
+        j = JinjaSql(param_style='numeric', deduplicate_params=True)
+        self.assertEqual(j.prepare_many("select {{ a }}, {{ b }}, {{ a }}", [{"a": 1, "b": 2}, {"a": 3, "b": 3}]),
+                         ("select :1, :2, :1", [[1, 2], [3, 3]]))
+
+    def test_prepare_many_chunks(self):
+        j = JinjaSql()
+        source = "insert into t (id) values ({% if id %}{{ id }}{% else %}0{% endif %})"
+        rows = ({"id": i} for i in range(1, 6))
+        chunks = list(j.prepare_many(source, rows, chunk_size=2))
+        self.assertEqual(chunks, [
+            ("insert into t (id) values (%s)", [[1], [2]]),
+            ("insert into t (id) values (%s)", [[3], [4]]),
+            ("insert into t (id) values (%s)", [[5]]),
+        ])
+
+        with self.assertRaises(InconsistentQueryException):
+            j.prepare_many(source, [{"id": 1}, {"id": None}])
+
+    @unittest.skipIf(sys.version_info < (3, 7), "async renders need contextvars")
+    def test_prepare_query_async(self):
+        async def fetch_user(user_id):
+            # Yield to the event loop, so that the renders interleave
+            await asyncio.sleep(0.01)
+            return "user-%s" % user_id
+
+        env = Environment(enable_async=True, loader=DictLoader({
+            "utils.sql": "{% macro where_id(value) %}where id = {{ value }}{% endmacro %}"
+        }))
+        j = JinjaSql(env, param_style='asyncpg')
+        source = ("{% import 'utils.sql' as utils %}"
+                  "select {{ fetch_user(user_id) }} from t {{ utils.where_id(user_id) }}")
+
+        async def render_all():
+            jobs = [j.prepare_query_async(source, {"user_id": i, "fetch_user": fetch_user})
+                    for i in range(5)]
+            return await asyncio.gather(*jobs)
+
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(render_all())
+        finally:
+            loop.close()
+
+        for i, (query, bind_params) in enumerate(results):
+            self.assertEqual(query, "select $1 from t where id = $2")
+            self.assertEqual(bind_params, ["user-%s" % i, i])
+
+    def test_inclause_bucketing(self):
+        source = "select * from t where id in {{ ids | inclause }}"
+        tests = [
+            ('repeat', [1], "(%s)", [1]),
+            ('repeat', [1, 2, 3], "(%s,%s,%s,%s)", [1, 2, 3, 3]),
+            ('null', [1, 2, 3, 4, 5], "(%s,%s,%s,%s,%s,%s,%s,%s)", [1, 2, 3, 4, 5, None, None, None]),
+            ('null', [1, 2, 3, 4], "(%s,%s,%s,%s)", [1, 2, 3, 4]),
+        ]
+        for bucketing, ids, expected_clause, expected_params in tests:
+            j = JinjaSql(in_clause_bucketing=bucketing)
+            query, bind_params = j.prepare_query(source, {"ids": ids})
+            self.assertEqual(query, "select * from t where id in " + expected_clause)
+            self.assertEqual(bind_params, expected_params)
+
+        with self.assertRaises(ValueError):
+            JinjaSql(in_clause_bucketing='round')
+
+        # NULL padding makes NOT IN match nothing, repeating the last value doesn't
+        import sqlite3
+        connection = sqlite3.connect(":memory:")
+        connection.execute("create table t (id integer)")
+        connection.executemany("insert into t values (?)", [(i,) for i in range(6)])
+        source = "select id from t where id not in {{ ids | inclause }} order by id"
+        for bucketing, expected in [('repeat', [(3,), (4,), (5,)]), ('null', [])]:
+            j = JinjaSql(param_style='qmark', in_clause_bucketing=bucketing)
+            rows = connection.execute(*j.prepare_query(source, {"ids": [0, 1, 2]})).fetchall()
+            self.assertEqual(rows, expected)
+        connection.close()
+
+    def test_prepare_query_stream(self):
+        source = ("insert into t (id, name) values "
+                  "{% for r in rows %}{% if not loop.first %},{% endif %}({{ r.id }}, {{ r.name }}){% endfor %}")
+        data = {"rows": [{"id": i, "name": "name-%s" % i} for i in range(100)]}
+        for param_style in JinjaSql.VALID_PARAM_STYLES:
+            j = JinjaSql(param_style=param_style)
+            expected_query, expected_params = j.prepare_query(source, data)
+
+            chunks = list(j.prepare_query_stream(source, data, buffer_size=64))
+            self.assertTrue(len(chunks) > 10)
+            self.assertEqual("".join(chunk for chunk, _ in chunks), expected_query)
+            if param_style in ('named', 'pyformat'):
+                params = {}
+                for _, chunk_params in chunks:
+                    params.update(chunk_params)
+            else:
+                params = [p for _, chunk_params in chunks for p in chunk_params]
+            self.assertEqual(params, expected_params)
+
+    def test_prepare_split_query(self):
+        j = JinjaSql(param_style='asyncpg')
+        rows = ({"id": i, "name": "n%s" % i} for i in range(7))
+        statements = list(j.prepare_split_query(
+            "insert into {{ table | identifier }} (id, name) values ",
+            "({{ row.id }}, {{ row.name }})", rows,
+            footer=" on conflict do nothing returning {{ marker }}",
+            data={"table": "t", "marker": "m"}, max_params=7))
+
+        self.assertEqual(statements, [
+            ('insert into "t" (id, name) values ($1, $2),($3, $4),($5, $6) on conflict do nothing returning $7',
+             [0, "n0", 1, "n1", 2, "n2", "m"]),
+            ('insert into "t" (id, name) values ($1, $2),($3, $4),($5, $6) on conflict do nothing returning $7',
+             [3, "n3", 4, "n4", 5, "n5", "m"]),
+            ('insert into "t" (id, name) values ($1, $2) on conflict do nothing returning $3',
+             [6, "n6", "m"]),
+        ])
+
+    def test_prepare_split_query_max_bytes(self):
+        j = JinjaSql(param_style='named')
+        statements = list(j.prepare_split_query(
+            "insert into t values ", "({{ row }})", range(5), max_bytes=45))
+        self.assertEqual(statements, [
+            ("insert into t values (:row_1),(:row_2)", {"row_1": 0, "row_2": 1}),
+            ("insert into t values (:row_1),(:row_2)", {"row_1": 2, "row_2": 3}),
+            ("insert into t values (:row_1)", {"row_1": 4}),
+        ])
+        with self.assertRaises(JinjaSqlException):
+            list(j.prepare_split_query("insert into t values ", "({{ row }})", range(5), max_bytes=20))
+
+        # Placeholders in the footer are as long as they are in the statement
+        j = JinjaSql(param_style='asyncpg')
+        statements = list(j.prepare_split_query("insert into t values ", "({{ row }})", range(40),
+                                                footer=" returning {{ m }}", data={"m": 1}, max_bytes=120))
+        self.assertEqual(max(len(query) for query, _ in statements), 115)
+        self.assertEqual(statements[0][0][-15:], ") returning $16")
+
+        j = JinjaSql(param_style='named')
+        statements = list(j.prepare_split_query("insert into t values ", "({{ row }}, {{ row }})", range(3),
+                                                max_params=4))
+        self.assertEqual(statements[1], ("insert into t values (:row_1, :row_2)", {"row_1": 2, "row_2": 2}))
+
+        # max_query_length also starts new statements
+        j = JinjaSql(max_query_length=40)
+        statements = list(j.prepare_split_query("insert into t values ", "({{ row }})", range(50)))
+        self.assertEqual(statements[0], ("insert into t values (%s),(%s),(%s),(%s)", [0, 1, 2, 3]))
+        self.assertEqual(len(statements), 13)
+        self.assertEqual(sum(len(params) for _, params in statements), 50)
+        with self.assertRaises(QueryLimitExceededException):
+            list(JinjaSql(max_query_length=24).prepare_split_query(
+                "insert into t values ", "({{ row }})", range(5)))
+
+    def test_deduplicate_params(self):
+        source = ("select * from a where project_id = {{ request.project_id }} "
+                  "and id in (select id from b where project_id = {{ request.project_id }} "
+                  "and day = {{ request.day }} and flag = {{ request.flag }})")
+        data = {"request": {"project_id": 123, "day": "mon", "flag": True}}
+        tests = [
+            ('named', ":request.project_id_1", ":request.project_id_1", ":request.day_2", ":request.flag_3",
+             {"request.project_id_1": 123, "request.day_2": "mon", "request.flag_3": True}),
+            ('asyncpg', "$1", "$1", "$2", "$3", [123, "mon", True]),
+            ('numeric', ":1", ":1", ":2", ":3", [123, "mon", True]),
+            ('format', "%s", "%s", "%s", "%s", [123, 123, "mon", True]),
+            ('qmark', "?", "?", "?", "?", [123, 123, "mon", True]),
+        ]
+        for param_style, p1, p2, p3, p4, expected_params in tests:
+            j = JinjaSql(param_style=param_style, deduplicate_params=True)
+            query, bind_params = j.prepare_query(source, data)
+            self.assertEqual(query, (
+                "select * from a where project_id = %s and id in (select id from b "
+                "where project_id = %s and day = %s and flag = %s)") % (p1, p2, p3, p4))
+            self.assertEqual(bind_params, expected_params)
+
+    def test_deduplicate_unhashable_params(self):
+        j = JinjaSql(param_style='asyncpg', deduplicate_params=True)
+        source = "select {{ a }}, {{ a }}, {{ b }}, {{ ids | inclause }}"
+        ids = [1, 2, 1]
+        query, bind_params = j.prepare_query(source, {"a": ids, "b": [1, 2, 1], "ids": ids})
+        self.assertEqual(query, "select $1, $1, $2, ($3,$4,$5)")
+        self.assertEqual(bind_params, [ids, [1, 2, 1], 1, 2, 1])
+        self.assertIs(bind_params[0], ids)
+
+    def test_deduplicate_keeps_values_alive(self):
+        # Values that are matched by identity must not be freed while the
+        # query renders, or a new value could get the id of an old one
+        class Value(object):
+            def __init__(self, v):
+                self.v = v
+            __hash__ = None
+
+        j = JinjaSql(param_style='numeric', deduplicate_params=True, adapters={Value: lambda v: v.v})
+        source = "{% for i in range(6) %}{{ make(i) }},{% endfor %}"
+        self.assertEqual(j.prepare_query(source, {"make": Value}),
+                         (":1,:2,:3,:4,:5,:6,", [0, 1, 2, 3, 4, 5]))
+
+        # Streamed chunks hand their parameters to the caller
+        j = JinjaSql(param_style='numeric', deduplicate_params=True)
+        chunks = list(j.prepare_query_stream("{% for i in range(6) %}{{ [i] }},{% endfor %}", {},
+                                             buffer_size=1))
+        self.assertEqual("".join(chunk for chunk, _ in chunks), ":1,:2,:3,:4,:5,:6,")
+        self.assertEqual([params for _, params in chunks if params],
+                         [[[0]], [[1]], [[2]], [[3]], [[4]], [[5]]])
+
+    def test_deduplicate_inclause(self):
+        # The text of an in clause only depends on the number of values
+        j = JinjaSql(param_style='numeric', deduplicate_params=True, in_clause_bucketing='repeat')
+        self.assertEqual(j.prepare_query("{{ a }} in {{ ids | inclause }}", {"a": 5, "ids": [5, 5, 5]}),
+                         (":1 in (:2,:3,:4,:5)", [5, 5, 5, 5, 5]))
+
+    def test_deduplicate_split_query(self):
+        j = JinjaSql(param_style='asyncpg', deduplicate_params=True)
+        statements = list(j.prepare_split_query(
+            "insert into t values ", "({{ row }}, {{ tenant }})", [1, 2, 3],
+            data={"tenant": "acme"}, max_params=3))
+        self.assertEqual(statements, [
+            ("insert into t values ($1, $2),($3, $2)", [1, "acme", 2]),
+            ("insert into t values ($1, $2)", [3, "acme"]),
+        ])
+
+    def test_adapters(self):
+        class Money(Decimal):
+            pass
+
+        class Point(object):
+            def __init__(self, x, y):
+                self.x, self.y = x, y
+
+        j = JinjaSql()
+        j.register_adapter(Decimal, str)
+        j.register_adapter(Point.__module__ + "." + Point.__qualname__, lambda p: "(%s,%s)" % (p.x, p.y))
+        blob = memoryview(b"binary")
+        data = {"price": Money("1.50"), "blob": blob, "day": date(2020, 1, 2),
+                "points": [Point(1, 2), Point(3, 4)]}
+        query, bind_params = j.prepare_query(
+            "select {{ price }}, {{ blob }}, {{ day }} where p in {{ points | inclause }}", data)
+        self.assertEqual(bind_params, ["1.50", blob, date(2020, 1, 2), "(1,2)", "(3,4)"])
+        self.assertIs(bind_params[1], blob)
+        # Adapters are looked up once per type
+        self.assertIs(j._adapter_cache[Money], str)
+
+        j.register_adapter(Decimal, None)
+        _, bind_params = j.prepare_query("select {{ price }}", data)
+        self.assertEqual(bind_params, [Decimal("1.50")])
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_numpy_adapters(self):
+        j = JinjaSql(param_style='asyncpg')
+        ids = numpy.array([1, 2, 3])
+        query, bind_params = j.prepare_query(
+            "select {{ ids }}, {{ n }} where id = {{ ids | anyclause }} and x in {{ ids | inclause }}",
+            {"ids": ids, "n": numpy.int64(5)})
+        self.assertEqual(query, "select $1, $2 where id = ANY($3) and x in ($4,$5,$6)")
+        self.assertEqual(bind_params, [[1, 2, 3], 5, [1, 2, 3], 1, 2, 3])
+        self.assertEqual([type(p) for p in bind_params], [list, int, list, int, int, int])
+
+    def test_limits(self):
+        j = JinjaSql(max_bind_params=3, max_inclause_size=2, max_query_length=60)
+        self.assertEqual(j.prepare_query("select {{ a }}, {{ b }} where x in {{ ids | inclause }}",
+                                         {"a": 1, "b": 2, "ids": [3]}),
+                         ("select %s, %s where x in (%s)", [1, 2, 3]))
+
+        def endless():
+            while True:
+                yield 1
+        with self.assertRaises(QueryLimitExceededException):
+            j.prepare_query("select {{ ids | inclause }}", {"ids": endless()})
+        with self.assertRaises(QueryLimitExceededException):
+            j.prepare_query("select {{ ids | anyclause }}", {"ids": [1, 2, 3]})
+        with self.assertRaises(QueryLimitExceededException):
+            j.prepare_query("select {{ a }}, {{ a }}, {{ a }}, {{ a }}", {"a": 1})
+        with self.assertRaises(QueryLimitExceededException):
+            j.prepare_query("{% for i in range(1000000000) %}select 1 union {% endfor %}", {})
+        with self.assertRaises(QueryLimitExceededException):
+            list(j.prepare_query_stream("{% for i in range(100) %}select 1 union {% endfor %}", {}))
+
+        # The limit applies to the in clause after padding
+        j = JinjaSql(in_clause_bucketing='null', max_inclause_size=6)
+        self.assertEqual(j.prepare_query("{{ ids | inclause }}", {"ids": [1, 2, 3]})[1], [1, 2, 3, None])
+        with self.assertRaises(QueryLimitExceededException):
+            j.prepare_query("{{ ids | inclause }}", {"ids": [1, 2, 3, 4, 5]})
+
+        # A repeated value that reuses its placeholder doesn't count
+        j = JinjaSql(param_style="numeric", deduplicate_params=True, max_bind_params=1)
+        self.assertEqual(j.prepare_query("{{ a }} {{ a }}", {"a": 1}), (":1 :1", [1]))
+
+    @unittest.skipIf(sys.version_info < (3, 7), "async renders need contextvars")
+    def test_limits_async(self):
+        j = JinjaSql(Environment(enable_async=True), max_query_length=20)
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(loop.run_until_complete(j.prepare_query_async(
+                "{% for i in ids %}{{ i }}{% endfor %}", {"ids": [1, 2]})), ("%s%s", [1, 2]))
+            with self.assertRaises(QueryLimitExceededException):
+                loop.run_until_complete(j.prepare_query_async(
+                    "{% for i in ids %}{{ i }}{% endfor %}", {"ids": range(100)}))
+
+            # The render is closed right away, not when it is garbage collected
+            closed = []
+            template = j._get_compiled("{% for i in ids %}{{ i }}{% endfor %}").template
+            generate_async = template.generate_async
+
+            async def tracked_generate_async(data):
+                try:
+                    async for part in generate_async(data):
+                        yield part
+                finally:
+                    closed.append(True)
+            template.generate_async = tracked_generate_async
+            with self.assertRaises(QueryLimitExceededException):
+                loop.run_until_complete(j.prepare_query_async(
+                    "{% for i in ids %}{{ i }}{% endfor %}", {"ids": range(100)}))
+            self.assertEqual(closed, [True])
+        finally:
+            loop.close()
+
+    def test_fingerprint(self):
+        j = JinjaSql(fingerprint=True)
+        source = "select *  from t\nwhere name = {{ name }} {% if day %}and day = {{ day }}{% endif %}"
+        query, bind_params, fingerprint = j.prepare_query(source, {"name": "a", "day": 1})
+        self.assertEqual((query, bind_params), ("select *  from t\nwhere name = %s and day = %s", ["a", 1]))
+        self.assertIsInstance(fingerprint, QueryFingerprint)
+
+        # Whitespace outside of literals doesn't change the shape
+        other = j.prepare_query("select * from t where name = {{ name }}   and day = {{ day }}",
+                                {"name": "a", "day": 1})[2]
+        self.assertEqual(other, fingerprint)
+        self.assertNotEqual(j.prepare_query(source, {"name": "a", "day": 2})[2].params, fingerprint.params)
+        self.assertNotEqual(j.prepare_query(source, {"name": "a", "day": "1"})[2].params, fingerprint.params)
+        self.assertNotEqual(j.prepare_query(source, {"name": "a"})[2].shape, fingerprint.shape)
+        self.assertNotEqual(j.prepare_query("select ' a  b' {{ x }}", {"x": 1})[2].shape,
+                            j.prepare_query("select ' a b' {{ x }}", {"x": 1})[2].shape)
+
+        # The same values give the same fingerprint in every process
+        self.assertEqual(JinjaSql(fingerprint=True).prepare_query(source, {"name": "a", "day": 1})[2],
+                         fingerprint)
+        # Values whose repr doesn't show their content are hashed by content
+        def params_hash(value):
+            return j.prepare_query("select {{ v }}", {"v": value})[2].params
+        self.assertNotEqual(params_hash(memoryview(b"a")), params_hash(memoryview(b"b")))
+        self.assertEqual(params_hash(memoryview(b"a")), params_hash(memoryview(b"a")))
+        self.assertNotEqual(params_hash([memoryview(b"a")]), params_hash([memoryview(b"b")]))
+        self.assertNotEqual(params_hash(b"a"), params_hash(memoryview(b"a")))
+        if numpy is not None:
+            first = numpy.zeros((100, 100))
+            second = first.copy()
+            second[50, 50] = 1
+            self.assertNotEqual(params_hash(first), params_hash(second))
+            self.assertNotEqual(params_hash(first), params_hash(first.astype("float32")))
+        with self.assertRaises(JinjaSqlException):
+            params_hash(object())
+
+        # Shapes are cached by a digest, not by the query text
+        self.assertNotIn(query, j._shapes._data)
+        self.assertEqual(j.prepare_query(source, {"name": "b", "day": 3})[2].shape, fingerprint.shape)
+
+    def test_share_environment(self):
+        first = JinjaSql(share_environment=True, param_style="qmark")
+        second = JinjaSql(share_environment=True, param_style="named")
+        backtick = JinjaSql(share_environment=True, identifier_quote_character="`")
+        self.assertIs(first.env, second.env)
+        self.assertIsNot(first.env, backtick.env)
+        self.assertIsNot(first.env, JinjaSql().env)
+
+        source = "select * from {{ table | identifier }} where id = {{ id }}"
+        self.assertEqual(first.prepare_query(source, {"table": "t", "id": 1}),
+                         ('select * from "t" where id = ?', [1]))
+        self.assertEqual(second.prepare_query(source, {"table": "t", "id": 1}),
+                         ('select * from "t" where id = :id_1', {"id_1": 1}))
+        self.assertEqual(backtick.prepare_query(source, {"table": "t", "id": 1}),
+                         ('select * from `t` where id = %s', [1]))
+        # Instances that share an environment also share compiled templates
+        self.assertEqual(first.cache_info().currsize, 1)
+        self.assertEqual(second.cache_info().hits, 1)
+
+    def test_lazy_import(self):
+        import subprocess
+        import sys
+        output = subprocess.check_output([
+            sys.executable, "-c",
+            "import sys, jinjasql; print('jinja2' in sys.modules); jinjasql.JinjaSql; print('jinja2' in sys.modules)"],
+            cwd=dirname(dirname(abspath(__file__))))
+        self.assertEqual(output.split(), [b"False", b"True"])
+
+    def test_analyze(self):
+        source = """
+        {% import 'utils.sql' as utils %}
+        {% macro where_day(day) %}day = {{ day }}{% endmacro %}
+        select {{ etc.columns | sqlsafe }} from {{ session.schema | identifier }}.timesheet
+        where project_id = {{ request.project.id }} and {{ where_day(request['day']) }}
+        and day in {{ request.days | inclause }} {{ utils.print_where(100) }}
+        {% for column in request.columns %}, {{ column.name | upper }}{% endfor %}
+        """
+        analysis = self.j.analyze(source)
+        self.assertEqual(analysis.bind_params, ("day", "request.project.id", "column.name"))
+        self.assertEqual(analysis.in_clauses, ("request.days",))
+        self.assertEqual(analysis.any_clauses, ())
+        self.assertEqual(analysis.identifiers, ("session.schema",))
+        self.assertEqual(analysis.sqlsafe, ("etc.columns",))
+        self.assertEqual(analysis.data_paths, frozenset([
+            "etc.columns", "session.schema", "request.project.id", "request.day",
+            "request.days", "request.columns"]))
+        self.assertIs(self.j.analyze(source), analysis)
+
+    def test_analyze_loaded_template(self):
+        env = Environment(loader=DictLoader({"report.sql": "select {{ a.b }} where x = {{ c ~ d }}"}))
+        j = JinjaSql(env)
+        template = env.get_template("report.sql")
+        analysis = j.analyze(template)
+        self.assertEqual(analysis.bind_params, ("a.b", "c"))
+        self.assertEqual(analysis.data_paths, frozenset(["a.b", "c", "d"]))
+        self.assertIs(j.analyze(template), analysis)
+        with self.assertRaises(ValueError):
+            j.analyze(env.from_string("select 1"))
+
+    def test_specialize(self):
+        source = """select {{ tenant.columns | sqlsafe }} from {{ tenant.schema | identifier }}.timesheet
+        where project_id = {{ request.project_id }}
+        {% if tenant.filter_days %}and day in {{ request.days | inclause }}
+        {% elif request.day %}and day = {{ request.day }}
+        {% else %}and tenant_id = {{ tenant.id }}{% endif %}
+        {% for column in tenant.order_by %}{{ column | identifier }}{{ tenant.separator }}{% endfor %}"""
+        for tenant in (
+                {"columns": "project, hours", "schema": "acme", "filter_days": True, "id": 5,
+                 "order_by": ["day"], "separator": ","},
+                {"columns": "hours", "schema": "initech", "filter_days": False, "id": 6,
+                 "order_by": [], "separator": ","}):
+            for param_style in ("format", "numeric", "named"):
+                j = JinjaSql(param_style=param_style)
+                template = j.specialize(source, {"tenant": tenant})
+                data = dict(_DATA, tenant=tenant)
+                self.assertEqual(j.prepare_query(template, _DATA), j.prepare_query(source, data))
+
+        j = JinjaSql()
+        template = j.specialize(source, {"tenant": {"columns": "hours", "schema": "acme",
+                                                    "filter_days": True, "order_by": []}})
+        query, bind_params = j.prepare_query(template, _DATA)
+        self.assertEqual(query.split(), "select hours from \"acme\".timesheet where project_id = %s "
+                                        "and day in (%s,%s,%s,%s,%s)".split())
+
+    def test_specialize_constant_elif(self):
+        source = ("select 1 {% if x %}A{% elif tenant.off %}B{% elif tenant.flag %}C{{ y }}"
+                  "{% elif z %}D{% else %}E{% endif %}")
+        j = JinjaSql()
+        template = j.specialize(source, {"tenant": {"flag": True, "off": False}})
+        for data in ({"x": 1}, {"x": 0, "y": 2, "z": 1}, {}):
+            self.assertEqual(j.prepare_query(template, data),
+                             j.prepare_query(source, dict(data, tenant={"flag": True, "off": False})))
+        self.assertEqual(j.prepare_query(template, {"y": 2}), ("select 1 C%s", [2]))
+
+    def test_specialize_plan(self):
+        j = JinjaSql()
+        template = j.specialize(
+            "select * from {{ schema | identifier }}.t where id = {{ id }}"
+            "{% if debug %} and {{ now() }} > 0{% endif %}",
+            {"schema": "acme", "debug": False})
+        self.assertIsNotNone(j._get_compiled(template).plan)
+        self.assertEqual(j.prepare_query(template, {"id": 1}),
+                         ('select * from "acme".t where id = %s', [1]))
+
 def generate_yaml_tests():
     file_path = join(YAML_TESTS_ROOT, "macros.yaml")
     with open(file_path) as f:
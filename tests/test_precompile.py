@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import unittest
+from jinja2 import DictLoader
+from jinja2 import Environment
+from jinjasql import JinjaSql
+from jinjasql.cli import main
+from jinjasql.precompile import precompile_templates
+
+_TEMPLATES = {
+    "utils.sql": "{% macro where_id(value) %}where id = {{ value }}{% endmacro %}",
+    "report.sql": (
+        "{% import 'utils.sql' as utils %}"
+        "select * from {{ table | identifier }} {{ utils.where_id(id) }}"
+        " and day in {{ days | inclause }}"
+    ),
+}
+
+_DATA = {"table": "users", "id": 12, "days": ["mon", "tue"]}
+
+
+class PrecompileTest(unittest.TestCase):
+    def setUp(self):
+        self.target = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.target)
+
+    def _assert_loads_without_compiling(self, j):
+        def fail(*args, **kwargs):
+            raise AssertionError("template was compiled at runtime")
+        j.env.compile = fail
+
+        query, bind_params = j.prepare_query(j.env.get_template("report.sql"), _DATA)
+        self.assertEqual(query, 'select * from `users` where id = :1 and day in (:2,:3)')
+        self.assertEqual(bind_params, [12, "mon", "tue"])
+
+    def test_precompile_loader(self):
+        precompile_templates(DictLoader(_TEMPLATES), self.target)
+        j = JinjaSql(param_style='numeric', identifier_quote_character='`',
+                     precompiled_templates=self.target)
+        self._assert_loads_without_compiling(j)
+
+    def test_cli(self):
+        source = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source)
+        for name, template in _TEMPLATES.items():
+            with open(os.path.join(source, name), "w") as f:
+                f.write(template)
+        with open(os.path.join(source, "README.txt"), "w") as f:
+            f.write("{{ not a template")
+
+        self.assertEqual(main(["compile", "-q", "-e", "sql", source, self.target]), 0)
+        j = JinjaSql(param_style='numeric', identifier_quote_character='`',
+                     precompiled_templates=self.target)
+        self._assert_loads_without_compiling(j)
+
+    def test_fallback_to_environment_loader(self):
+        precompile_templates(DictLoader(_TEMPLATES), self.target)
+        env = Environment(loader=DictLoader({"other.sql": "select {{ id }}"}))
+        j = JinjaSql(env, precompiled_templates=self.target)
+        query, bind_params = j.prepare_query(j.env.get_template("other.sql"), _DATA)
+        self.assertEqual((query, bind_params), ("select %s", [12]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import unittest
+from threading import Event
+from jinja2 import Environment
+from jinja2 import FileSystemLoader
+from jinjasql import JinjaSql
+
+_TEMPLATES = {
+    "utils.sql": "{% macro where_id(value) %}where id = {{ value }}{% endmacro %}",
+    "report.sql": "{% import 'utils.sql' as utils %}select * from users {{ utils.where_id(id) }}",
+    "summary.sql": "select count(*) from users",
+}
+
+
+class ReloadTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for name, source in _TEMPLATES.items():
+            self._write(name, source)
+        self.j = JinjaSql(Environment(loader=FileSystemLoader(self.root), auto_reload=True))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _write(self, name, source, age=100):
+        path = os.path.join(self.root, name)
+        with open(path, "w") as f:
+            f.write(source)
+        # Modification times only have a resolution of a second on
+        # some file systems, so make the change visible
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime - age))
+
+    def _render(self, name):
+        return self.j.prepare_query(self.j.env.get_template(name), {"id": 7})
+
+    def _cached(self):
+        return sorted(name for name, template in self.j._loaded_templates())
+
+    def test_watch_templates(self):
+        watcher = self.j.watch_templates(interval=3600)
+        self.assertFalse(self.j.env.auto_reload)
+        self.assertIs(self.j.watch_templates(), watcher)
+
+        self.assertEqual(self._render("report.sql"), ("select * from users where id = %s", [7]))
+        self._render("summary.sql")
+        self.assertEqual(watcher.check(), [])
+        self.assertEqual(self._cached(), ["report.sql", "summary.sql", "utils.sql"])
+
+        # Without auto_reload, nothing changes until the watcher notices
+        self._write("utils.sql", "{% macro where_id(value) %}where user_id = {{ value }}{% endmacro %}", age=0)
+        self.assertEqual(self._render("report.sql"), ("select * from users where id = %s", [7]))
+
+        self.assertEqual(watcher.check(), ["utils.sql"])
+        self.assertEqual(self._cached(), ["summary.sql"])
+        self.assertEqual(self._render("report.sql"), ("select * from users where user_id = %s", [7]))
+
+        watcher.stop()
+        self.assertTrue(self.j.env.auto_reload)
+        self.assertIsNone(self.j._watcher)
+
+    def test_watcher_survives_errors(self):
+        checked = Event()
+        calls = []
+        loaded_templates = self.j._loaded_templates
+
+        def flaky_loaded_templates():
+            calls.append(None)
+            if len(calls) == 1:
+                raise KeyError("evicted")
+            checked.set()
+            return loaded_templates()
+        self.j._loaded_templates = flaky_loaded_templates
+
+        with self.j.watch_templates(interval=0.01):
+            self.assertTrue(checked.wait(5))
+
+    def test_invalidate_template(self):
+        self._render("report.sql")
+        # Dependencies are only tracked while watching
+        self.assertEqual(self.j.invalidate_template("utils.sql"), ["utils.sql"])
+        self.assertEqual(self._cached(), ["report.sql"])
+
+        with self.j.watch_templates(interval=3600) as watcher:
+            self._render("report.sql")
+            watcher.check()
+            self.assertEqual(self.j.invalidate_template("utils.sql"), ["report.sql", "utils.sql"])
+            self.assertEqual(self._cached(), [])
+            self.assertEqual(self.j.invalidate_template("missing.sql"), ["missing.sql"])
+
+
+if __name__ == '__main__':
+    unittest.main()